@@ -0,0 +1,222 @@
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Intervalo (em segundos) entre duas atualizações da posição na fila para quem espera
+POSITION_POLL_INTERVAL = 0.5
+
+
+def admission_settings() -> dict:
+    return {
+        # Cota da conta na Groq; 0 desliga o limite correspondente
+        'requests_per_minute': int(os.getenv('GROQ_REQUESTS_PER_MINUTE', '30')),
+        'tokens_per_minute': int(os.getenv('GROQ_TOKENS_PER_MINUTE', '0')),
+        # Perguntas chamando o LLM ao mesmo tempo no processo; as demais esperam na fila
+        'max_concurrent_requests': int(os.getenv('ADMISSION_MAX_CONCURRENT', '4')),
+        # Chamadas simultâneas ao encoder (CPU); acima disso as threads só disputam os núcleos
+        'encoder_concurrency': int(os.getenv('ADMISSION_ENCODER_CONCURRENCY', '1')),
+        # Com a fila cheia ou a espera estourada a pergunta é recusada na hora, sem acumular atraso
+        'max_queue': int(os.getenv('ADMISSION_MAX_QUEUE', '32')),
+        'max_wait': float(os.getenv('ADMISSION_MAX_WAIT', '60')),
+        'quota_wait': float(os.getenv('ADMISSION_QUOTA_WAIT', '20')),
+    }
+
+
+class Overloaded(Exception):
+    """O processo está no limite (fila cheia, espera longa demais ou cota esgotada)."""
+
+
+class TokenBucket:
+    """Balde de fichas reabastecido continuamente a `per_minute` fichas por minuto."""
+
+    def __init__(self, per_minute: float, capacity: float = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, cost: float = 1.0) -> float:
+        """0 se as fichas foram retiradas; senão, quantos segundos faltam para haver o bastante."""
+        cost = min(cost, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return 0.0
+            return (cost - self.tokens) / self.rate
+
+    def acquire(self, cost: float = 1.0, timeout: float = None) -> bool:
+        """Espera pelas fichas; False, sem esperar à toa, se elas não vão estar lá dentro de `timeout`."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            missing = self.try_acquire(cost)
+            if missing == 0.0:
+                return True
+            if deadline is not None and time.monotonic() + missing > deadline:
+                return False
+            time.sleep(missing)
+
+
+class Ticket:
+    """Lugar de uma pergunta na fila do FairScheduler."""
+
+    def __init__(self, scheduler, session_id: str, order: tuple):
+        self.scheduler = scheduler
+        self.session_id = session_id
+        self.order = order
+        self.granted = False
+        self.done = False
+
+    @property
+    def position(self) -> int:
+        """Posição na fila (1 = a próxima a entrar); 0 quando já foi admitida."""
+        return self.scheduler.position(self)
+
+    def wait(self, timeout: float = None) -> bool:
+        return self.scheduler.wait(self, timeout)
+
+    def release(self):
+        self.scheduler.release(self)
+
+
+class FairScheduler:
+    """Limita quantas perguntas rodam ao mesmo tempo; as demais esperam numa fila justa.
+
+    As perguntas de cada sessão saem na ordem em que chegaram e as sessões são
+    atendidas em rodízio: cada pergunta recebe uma etiqueta uma rodada depois da
+    anterior da mesma sessão (ou da rodada atual) e entra quem tiver a menor. Assim
+    uma sessão com várias perguntas (ou o pré-cálculo das sugestões) não passa na
+    frente de quem chegou depois com uma só.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiting = []
+        self._last_round = {}
+        self._round = 0
+        self._arrivals = itertools.count()
+        self._condition = threading.Condition()
+
+    def queued(self) -> int:
+        with self._condition:
+            return len(self._waiting)
+
+    def enqueue(self, session_id: str) -> Ticket:
+        with self._condition:
+            if len(self._waiting) >= self.max_queue:
+                raise Overloaded(f"fila cheia ({self.max_queue} perguntas esperando)")
+            round_ = max(self._round, self._last_round.get(session_id, 0)) + 1
+            self._last_round[session_id] = round_
+            ticket = Ticket(self, session_id, (round_, next(self._arrivals)))
+            self._waiting.append(ticket)
+            self._admit()
+            return ticket
+
+    def _admit(self):
+        while self.active < self.max_concurrency and self._waiting:
+            ticket = min(self._waiting, key=lambda waiting: waiting.order)
+            self._waiting.remove(ticket)
+            self._round = ticket.order[0]
+            ticket.granted = True
+            self.active += 1
+        # Sessões sem perguntas à frente da rodada atual não precisam mais ser lembradas
+        self._last_round = {session: round_ for session, round_ in self._last_round.items() if round_ > self._round}
+        self._condition.notify_all()
+
+    def position(self, ticket: Ticket) -> int:
+        with self._condition:
+            if ticket.granted or ticket.done:
+                return 0
+            return 1 + sum(other.order < ticket.order for other in self._waiting)
+
+    def wait(self, ticket: Ticket, timeout: float = None) -> bool:
+        with self._condition:
+            return self._condition.wait_for(lambda: ticket.granted, timeout)
+
+    def release(self, ticket: Ticket):
+        """Libera a vaga da pergunta admitida, ou a tira da fila se ainda não entrou."""
+        with self._condition:
+            if ticket.done:
+                return
+            ticket.done = True
+            if ticket.granted:
+                self.active -= 1
+            else:
+                self._waiting.remove(ticket)
+            self._admit()
+
+
+class AdmissionController:
+    """Controle de admissão compartilhado pelas sessões do processo.
+
+    Perguntas que vão chamar o LLM passam pela fila justa (`admit`), cada chamada à
+    Groq retira fichas dos baldes ajustados à cota da conta (`take_llm_quota`) e as
+    chamadas ao encoder disputam `encoder_slot`. Sob carga o tempo de resposta cresce
+    de forma previsível (fila com posição) e o excesso é recusado com Overloaded, em
+    vez de virar uma cascata de 429 e de threads disputando a CPU.
+    """
+
+    def __init__(self, settings: dict = None):
+        self.settings = settings or admission_settings()
+        self.requests = FairScheduler(self.settings['max_concurrent_requests'], self.settings['max_queue'])
+        self.encoder = threading.BoundedSemaphore(self.settings['encoder_concurrency'])
+        rpm, tpm = self.settings['requests_per_minute'], self.settings['tokens_per_minute']
+        self.request_rate = TokenBucket(rpm) if rpm > 0 else None
+        self.token_rate = TokenBucket(tpm) if tpm > 0 else None
+
+    @contextmanager
+    def admit(self, session_id: str, on_position=None):
+        """Espera a vez da pergunta na fila, chamando `on_position(posição)` quando ela muda.
+
+        Se a pergunta chegou a esperar, `on_position(0)` avisa que ela foi admitida.
+        """
+        ticket = self.requests.enqueue(session_id)
+        try:
+            deadline = time.monotonic() + self.settings['max_wait']
+            position = None
+            while not ticket.wait(POSITION_POLL_INTERVAL):
+                if time.monotonic() > deadline:
+                    raise Overloaded(f"a pergunta esperou mais de {self.settings['max_wait']:g}s na fila")
+                if on_position is not None and ticket.position != position:
+                    position = ticket.position
+                    on_position(position)
+            if position is not None:
+                on_position(0)
+            yield ticket
+        finally:
+            ticket.release()
+
+    def take_llm_quota(self, tokens: int = 0, wait: bool = True) -> bool:
+        """Retira da cota da Groq uma requisição com `tokens` tokens de prompt.
+
+        Com `wait=False` só retira se houver cota agora (usado pelo hedge, que não deve esperar).
+        """
+        timeout = self.settings['quota_wait'] if wait else 0.0
+        if self.token_rate is not None and tokens and not self.token_rate.acquire(tokens, timeout):
+            return False
+        return self.request_rate is None or self.request_rate.acquire(1, timeout)
+
+    @contextmanager
+    def encoder_slot(self):
+        with self.encoder:
+            yield
+
+
+_controller = None
+_lock = threading.Lock()
+
+
+def get_admission_controller() -> AdmissionController:
+    global _controller
+    if _controller is None:
+        with _lock:
+            if _controller is None:
+                _controller = AdmissionController()
+    return _controller
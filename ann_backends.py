@@ -0,0 +1,250 @@
+import os
+
+import numpy as np
+
+# Bloco de linhas usado nas multiplicações grandes, para limitar a memória temporária
+BLOCK_SIZE = 4096
+
+
+def top_k_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    """Índices das k maiores similaridades, em ordem decrescente."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class ExactBackend:
+    """Busca exata: uma multiplicação matriz-vetor sobre todas as embeddings."""
+
+    name = 'exact'
+    # Scores exatos dispensam o reranqueamento com os vetores em precisão total
+    exact = True
+
+    def __init__(self):
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+
+    def params(self) -> dict:
+        return {}
+
+    def build(self, matrix: np.ndarray):
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+
+    def search(self, query: np.ndarray, k: int):
+        scores = self.matrix @ query
+        rows = top_k_rows(scores, k)
+        return rows, scores[rows]
+
+    def save(self, directory: str):
+        np.save(os.path.join(directory, 'matrix.npy'), self.matrix)
+
+    def load(self, directory: str, meta: dict):
+        # mmap: processos que carregam o mesmo arquivo compartilham as páginas em memória
+        self.matrix = np.load(os.path.join(directory, 'matrix.npy'), mmap_mode='r')
+
+
+class IVFBackend:
+    """Índice invertido (IVF): k-means esférico particiona os vetores em listas
+    e a busca varre apenas as `n_probe` listas mais próximas da pergunta.
+
+    Mais listas sondadas aumentam o recall às custas de velocidade.
+    """
+
+    name = 'ivf'
+    exact = True
+
+    def __init__(self, n_lists: int = 0, n_probe: int = 8, iterations: int = 10, seed: int = 0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = np.empty((0, 0), dtype=np.float32)
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self.rows = np.empty(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+
+    def params(self) -> dict:
+        return {'n_lists': self.n_lists, 'n_probe': self.n_probe, 'iterations': self.iterations, 'seed': self.seed}
+
+    @staticmethod
+    def _assign(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        assignment = np.empty(len(matrix), dtype=np.int64)
+        for start in range(0, len(matrix), BLOCK_SIZE):
+            block = matrix[start:start + BLOCK_SIZE]
+            assignment[start:start + BLOCK_SIZE] = np.argmax(block @ centroids.T, axis=1)
+        return assignment
+
+    def build(self, matrix: np.ndarray):
+        n = len(matrix)
+        if n == 0:
+            return
+        n_lists = min(self.n_lists or max(1, int(np.sqrt(n))), n)
+        rng = np.random.default_rng(self.seed)
+        centroids = matrix[rng.choice(n, n_lists, replace=False)].copy()
+
+        for _ in range(self.iterations):
+            assignment = self._assign(matrix, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, matrix)
+            filled = np.bincount(assignment, minlength=n_lists) > 0
+            # Listas vazias mantêm o centróide anterior
+            norms = np.linalg.norm(sums[filled], axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids[filled] = sums[filled] / norms
+
+        assignment = self._assign(matrix, centroids)
+        order = np.argsort(assignment, kind='stable')
+        self.centroids = centroids.astype(np.float32)
+        self.vectors = np.ascontiguousarray(matrix[order], dtype=np.float32)
+        self.rows = order.astype(np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))]).astype(np.int64)
+
+    def search(self, query: np.ndarray, k: int):
+        if len(self.rows) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        probed = top_k_rows(self.centroids @ query, self.n_probe)
+        candidates = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in probed])
+        scores = self.vectors[candidates] @ query
+        top = top_k_rows(scores, k)
+        return self.rows[candidates[top]], scores[top]
+
+    def save(self, directory: str):
+        for name in ('centroids', 'vectors', 'rows', 'offsets'):
+            np.save(os.path.join(directory, f'ivf_{name}.npy'), getattr(self, name))
+
+    def load(self, directory: str, meta: dict):
+        for name in ('centroids', 'vectors', 'rows', 'offsets'):
+            mmap_mode = 'r' if name == 'vectors' else None
+            setattr(self, name, np.load(os.path.join(directory, f'ivf_{name}.npy'), mmap_mode=mmap_mode))
+
+
+class Int8Backend:
+    """Cópia quantizada em int8 com escala por vetor (4x menor que float32).
+
+    Serve como primeira passada aproximada; os melhores candidatos são depois
+    reranqueados com os vetores em precisão total.
+    """
+
+    name = 'int8'
+    exact = False
+
+    def __init__(self):
+        self.codes = np.empty((0, 0), dtype=np.int8)
+        self.scales = np.empty(0, dtype=np.float32)
+
+    def params(self) -> dict:
+        return {}
+
+    def build(self, matrix: np.ndarray):
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        self.codes = np.ascontiguousarray(np.rint(matrix / scales[:, None]), dtype=np.int8)
+        self.scales = scales.astype(np.float32)
+
+    def search(self, query: np.ndarray, k: int):
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        # A conversão para float32 é feita por blocos para não materializar a matriz inteira
+        for start in range(0, len(self.codes), BLOCK_SIZE):
+            block = self.codes[start:start + BLOCK_SIZE].astype(np.float32)
+            scores[start:start + BLOCK_SIZE] = block @ query
+        scores *= self.scales
+        rows = top_k_rows(scores, k)
+        return rows, scores[rows]
+
+    def save(self, directory: str):
+        np.save(os.path.join(directory, 'int8_codes.npy'), self.codes)
+        np.save(os.path.join(directory, 'int8_scales.npy'), self.scales)
+
+    def load(self, directory: str, meta: dict):
+        self.codes = np.load(os.path.join(directory, 'int8_codes.npy'), mmap_mode='r')
+        self.scales = np.load(os.path.join(directory, 'int8_scales.npy'))
+
+
+class HNSWBackend:
+    """Grafo HNSW via `hnswlib` (dependência opcional).
+
+    `m` e `ef_construction` controlam a qualidade do grafo; `ef_search` troca
+    velocidade por recall na consulta.
+    """
+
+    name = 'hnsw'
+    exact = True
+
+    def __init__(self, m: int = 16, ef_construction: int = 200, ef_search: int = 64):
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.index = None
+        self.count = 0
+
+    def params(self) -> dict:
+        return {'m': self.m, 'ef_construction': self.ef_construction, 'ef_search': self.ef_search}
+
+    @staticmethod
+    def _hnswlib():
+        try:
+            import hnswlib
+        except ImportError as e:
+            raise ImportError("O backend 'hnsw' requer o pacote hnswlib: pip install hnswlib") from e
+        return hnswlib
+
+    def build(self, matrix: np.ndarray):
+        self.count = len(matrix)
+        if self.count == 0:
+            return
+        hnswlib = self._hnswlib()
+        self.index = hnswlib.Index(space='ip', dim=matrix.shape[1])
+        self.index.init_index(max_elements=self.count, ef_construction=self.ef_construction, M=self.m)
+        self.index.add_items(matrix, np.arange(self.count))
+        self.index.set_ef(self.ef_search)
+
+    def search(self, query: np.ndarray, k: int):
+        k = min(k, self.count)
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        labels, distances = self.index.knn_query(query, k=k)
+        # No espaço 'ip' o hnswlib devolve 1 - produto interno
+        return labels[0].astype(np.int64), 1.0 - distances[0]
+
+    def save(self, directory: str):
+        if self.index is not None:
+            self.index.save_index(os.path.join(directory, 'hnsw.bin'))
+
+    def load(self, directory: str, meta: dict):
+        self.count = meta['count']
+        if self.count == 0:
+            return
+        hnswlib = self._hnswlib()
+        self.index = hnswlib.Index(space='ip', dim=meta['dim'])
+        self.index.load_index(os.path.join(directory, 'hnsw.bin'), max_elements=self.count)
+        self.index.set_ef(self.ef_search)
+
+
+BACKENDS = {backend.name: backend for backend in (ExactBackend, IVFBackend, Int8Backend, HNSWBackend)}
+
+# Parâmetros ajustáveis por variável de ambiente, ex.: IVF_N_PROBE=16, HNSW_EF_SEARCH=128
+ENV_PARAMS = {
+    'ivf': {'n_lists': 'IVF_N_LISTS', 'n_probe': 'IVF_N_PROBE', 'iterations': 'IVF_ITERATIONS'},
+    'hnsw': {'m': 'HNSW_M', 'ef_construction': 'HNSW_EF_CONSTRUCTION', 'ef_search': 'HNSW_EF_SEARCH'},
+}
+
+# Quantos candidatos por resultado a primeira passada aproximada devolve para reranqueamento
+RESCORE_FACTOR = int(os.getenv('INT8_RESCORE_FACTOR', '4'))
+
+
+def backend_params_from_env(name: str) -> dict:
+    """Lê os parâmetros de recall/velocidade do backend a partir do ambiente."""
+    return {
+        param: int(os.environ[variable])
+        for param, variable in ENV_PARAMS.get(name, {}).items()
+        if os.getenv(variable)
+    }
+
+
+def create_backend(name: str, **params):
+    """Instancia o backend de busca pelo nome ('exact', 'ivf', 'int8' ou 'hnsw')."""
+    try:
+        return BACKENDS[name](**params)
+    except KeyError:
+        raise ValueError(f"Backend de índice vetorial desconhecido: {name!r}. Opções: {', '.join(BACKENDS)}")
@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """Respostas já geradas, encontradas pela similaridade do embedding da pergunta.
+
+    Uma pergunta reaproveita a resposta de outra quando o cosseno entre as duas
+    passa de `threshold` ("horário do treino?" e "quando treinam?"). As entradas
+    expiram após `ttl` segundos, as mais antigas saem quando o cache passa de
+    `max_size` e tudo é descartado quando a versão muda (geração da base de
+    conhecimento e versão dos prompts).
+    """
+
+    def __init__(self, threshold: float, ttl: float, max_size: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.version = None
+        self._entries = []
+        self._matrix = None
+        self._lock = threading.Lock()
+
+    def _reset(self, version):
+        self.version = version
+        self._entries = []
+        self._matrix = None
+
+    def _expire(self):
+        now = time.monotonic()
+        alive = [entry for entry in self._entries if now - entry['created_at'] < self.ttl]
+        if len(alive) > self.max_size:
+            alive = alive[-self.max_size:]
+        if len(alive) != len(self._entries):
+            self._entries = alive
+            self._matrix = np.stack([entry['embedding'] for entry in alive]) if alive else None
+
+    def lookup(self, query_embedding, version):
+        """Entrada da pergunta mais parecida acima do limite ({'question', 'answer', 'documents', ...}) ou None."""
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        with self._lock:
+            if version != self.version:
+                self._reset(version)
+            self._expire()
+            if self._matrix is None:
+                self.misses += 1
+                return None
+            similarities = self._matrix @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return {**self._entries[best], 'similarity': float(similarities[best])}
+
+    def store(self, question: str, query_embedding, answer: str, documents: list, version):
+        embedding = np.asarray(query_embedding, dtype=np.float32)
+        embedding = embedding / (np.linalg.norm(embedding) or 1.0)
+        entry = {
+            'question': question,
+            'answer': answer,
+            'documents': documents,
+            'embedding': embedding,
+            'created_at': time.monotonic(),
+        }
+        with self._lock:
+            if version != self.version:
+                self._reset(version)
+            self._entries.append(entry)
+            self._matrix = embedding[None, :] if self._matrix is None else np.vstack([self._matrix, embedding])
+            self._expire()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'version': self.version,
+        }
+
+
+_cache = None
+_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """Cache de respostas compartilhado pelas sessões do processo, ou None se desligado."""
+    global _cache
+    if _cache is None:
+        max_size = int(os.getenv('ANSWER_CACHE_SIZE', '512'))
+        if max_size <= 0:
+            return None
+        with _lock:
+            if _cache is None:
+                _cache = SemanticAnswerCache(
+                    threshold=float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.92')),
+                    ttl=float(os.getenv('ANSWER_CACHE_TTL', '3600')),
+                    max_size=max_size,
+                )
+    return _cache
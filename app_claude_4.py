@@ -1,16 +1,23 @@
 import streamlit as st
-import time
 import os
-from groq import Groq
 from dotenv import load_dotenv
-import yaml
 from datetime import datetime
+from uuid import uuid4
 import json
-from sentence_transformers import SentenceTransformer
-import numpy as np
-from scipy.spatial.distance import cosine
 import heapq
-from pymongo import MongoClient
+from admission import Overloaded, get_admission_controller
+from chunking import expand_with_neighbours
+from context_builder import build_context, context_settings, log_prompt_stats
+from embedding_model import encode, is_ready, start_warmup
+from knowledge_base import get_mongo_client, resolve_collection
+from lexical_index import hybrid_search
+from llm_client import get_llm_client
+from member_routing import find_member_document
+from prompt_layout import CONTEXT_INSTRUCTIONS, build_chat_messages, count_message_tokens
+from prompt_registry import get_prompt_registry
+from request_pipeline import RequestCancelled, RequestPipeline
+from suggestions import find_prewarmed_answer, load_suggestions, start_suggestion_refresh
+from vector_index import set_retrieval_mode
 
 # Configuração da página
 st.set_page_config(
@@ -195,111 +202,174 @@ if 'session_start' not in st.session_state:
     st.session_state.session_start = datetime.now()
 if 'input_key' not in st.session_state:
     st.session_state.input_key = 0
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid4().hex
 
 # Carregar configurações
 load_dotenv()
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 MONGO_URI = os.getenv('MONGO_URI')
+RETRIEVAL_MODE = os.getenv('RETRIEVAL_MODE', 'client')
+ANSWER_MODEL = "meta-llama/llama-4-maverick-17b-128e-instruct"
+
+# Perguntas dos botões de sugestão (podem ser trocadas em `suggested_questions` no prompts.yaml)
+SUGGESTIONS = load_suggestions([
+    {"label": "Quem são os membros da equipe?", "question": "Quem são os membros da equipe PingPoli?"},
+    {"label": "Horários de treino", "question": "Quais são os horários de treino da equipe?"},
+    {"label": "Próximos campeonatos", "question": "Quais são os próximos campeonatos da equipe?"},
+])
 
 # Verificar se a API key existe
 if not GROQ_API_KEY:
     st.error("🚨 API Key do GROQ não encontrada! Verifique seu arquivo .env")
     st.stop()
 
-groq_client = Groq(api_key=GROQ_API_KEY)
+groq_client = get_llm_client(GROQ_API_KEY)
+
+# O modelo de embedding aquece em segundo plano, uma vez por processo
+start_warmup()
 
 def transform_sentence_to_embedding(input_text: str):
-    model = SentenceTransformer('PORTULAN/serafim-100m-portuguese-pt-sentence-encoder-ir')
-    embedding = model.encode(input_text)
+    embedding = encode(input_text)
     
     return embedding
 
 def connection_mongodb():
-    mongo_client = MongoClient(MONGO_URI)
+    mongo_client = get_mongo_client(MONGO_URI)
     db = mongo_client["pingpoli"]
-    collection = db["members_informations"]
+    # Geração ativa da base, trocada pelo important_script.py sem derrubar o app
+    collection = resolve_collection(db, "members_informations")
+    set_retrieval_mode(collection, RETRIEVAL_MODE)
     
     return collection
 
-def search_for_documents(input_text_embedding: np.array) -> list:
+def search_for_documents(input_text: str) -> list:
     collection = connection_mongodb()
+    k = context_settings()['max_passages']
 
-    rag_text_similarity_list = []
-    k = 3
-
-    for document in collection.find({}, {'_id': 0, 'text': 1, 'embedding': 1}):
-        embedding = document['embedding']
-        text = document['text']
-
-        cos_similarity = 1 - cosine(input_text_embedding, embedding)
-
-        if len(rag_text_similarity_list) < k:
-            rag_text_similarity_list.append({'text': text, 'similarity': cos_similarity})
-        else:
-            min_similarity_item = min(rag_text_similarity_list, key=lambda x: x['similarity'])
-
-            if cos_similarity > min_similarity_item['similarity']:
-                index_to_replace = rag_text_similarity_list.index(min_similarity_item)
-                rag_text_similarity_list.pop(index_to_replace)
-                rag_text_similarity_list.append({'text': text, 'similarity': cos_similarity})
+    passages = hybrid_search(collection, input_text, transform_sentence_to_embedding, k)
 
-    rag_text_similarity_list.sort(key=lambda x: x['similarity'], reverse=True)
+    return expand_with_neighbours(collection, passages)
 
-    return rag_text_similarity_list
-
-def load_prompt_from_yaml(prompt_name: str, user_input: str) -> str:
-    """Carrega prompt do arquivo YAML"""
+def load_prompt_from_yaml(prompt_name: str, user_input: str) -> list:
+    """Mensagens de um prompt do arquivo YAML (interpretado uma vez e recarregado quando muda)"""
     try:
-        with open("prompts.yaml", "r", encoding="utf-8") as file:
-            config = yaml.safe_load(file)
-        return config[prompt_name].format(user_input=user_input)
-    except FileNotFoundError:
-        return f"Você é um especialista em tênis de mesa e conhece tudo sobre a equipe PingPoli. Responda a seguinte pergunta de forma detalhada e útil: {user_input}"
-    except Exception as e:
-        return f"Erro ao carregar prompt: {str(e)}"
-
-def animate_text_response(text: str, placeholder):
-    """Anima a resposta texto por texto"""
+        return get_prompt_registry().render_messages(prompt_name, user_input=user_input)
+    except KeyError:
+        # Nenhuma versão válida do arquivo foi carregada ainda, ou o prompt não existe
+        return [
+            {"role": "system", "content": "Você é um especialista em tênis de mesa e conhece tudo sobre a equipe PingPoli. Responda a pergunta de forma detalhada e útil."},
+            {"role": "user", "content": user_input},
+        ]
+
+def stream_text_response(chunks, placeholder) -> str:
+    """Exibe a resposta à medida que os pedaços chegam e devolve o texto completo"""
     response = ""
-    for char in text:
-        response += char
+    for chunk in chunks:
+        response += chunk
         placeholder.markdown(f'<div class="bot-message message-animate">{response}▋</div>', unsafe_allow_html=True)
-        time.sleep(0.01)
     placeholder.markdown(f'<div class="bot-message message-animate">{response}</div>', unsafe_allow_html=True)
+    return response
+
+def retrieve_documents(collection, user_input: str) -> list:
+    """Documentos de contexto da pergunta"""
+    # Perguntas sobre um membro específico vão direto ao documento dele
+    member_document = find_member_document(collection, user_input)
+    return [member_document] if member_document else search_for_documents(user_input)
 
-def generate_answer(user_input: str, system_user_prompt: str, model: str = "llama-3.3-70b-versatile", stream: bool = False, temperature: float = 0.8) -> str:
-    """Gera resposta usando a API do GROQ"""
+def build_final_prompt(retrieved_documents: list, prompt_messages: list) -> tuple:
+    """Mensagens finais com o CONTEXTO limitado ao orçamento de tokens, e as estatísticas da montagem
 
-    input_embedding = transform_sentence_to_embedding(user_input)
-    retrieved_documents = search_for_documents(input_embedding)
+    O system (diretrizes + instruções) vem primeiro e é igual em todas as perguntas, para
+    aproveitar o cache de prompt do provedor; CONTEXTO e PERGUNTA vão no fim.
+    """
+    context, stats = build_context(retrieved_documents)
+    messages = build_chat_messages(prompt_messages, CONTEXT_INSTRUCTIONS, context)
+    stats['prompt_tokens'] = count_message_tokens(messages)
+    log_prompt_stats(stats)
+    return messages, stats
 
-    context = "\n\n---\n\n".join([doc['text'] for doc in retrieved_documents])
+def request_completion(messages: list, model: str, stream: bool = False, temperature: float = 0.8):
+    """Chama a API do GROQ; erros são propagados para quem chamou
 
-    final_prompt = f"""
-    Você é um assistente de IA especialista. Use o CONTEXTO fornecido abaixo para responder à PERGUNTA do usuário.
-    Responda de forma clara e concisa, baseando-se exclusivamente nas informações do CONTEXTO.
-    Se a resposta não estiver no CONTEXTO, diga educadamente: "Não encontrei informações sobre isso nos meus documentos."
+    Com `stream=True` devolve um gerador com os pedaços do texto, à medida que o GROQ os envia
+    """
+    # Timeouts, novas tentativas em 429/5xx, hedge e modelo reserva ficam no llm_client
+    return groq_client.complete(messages, model, temperature=temperature, stream=stream)
 
-    CONTEXTO:
-    {context}
+def generate_answer(user_input: str, system_user_prompt: str = None, model: str = "llama-3.3-70b-versatile", stream: bool = False, temperature: float = 0.8,
+                    session_id: str = "default", on_queue_position=None):
+    """Gera resposta usando a API do GROQ
 
-    PERGUNTA:
-    {system_user_prompt}
+    Com `stream=True` devolve um gerador com os pedaços da resposta, para exibi-la enquanto é gerada.
+    Sem `system_user_prompt`, o prompt é carregado em paralelo à busca dos documentos; com ele,
+    o texto é enviado como a pergunta do usuário. A chamada ao GROQ espera a vez na fila do
+    processo (justa entre sessões); `on_queue_position(posição)` é chamado enquanto ela espera.
     """
+    chunks = stream_answer(user_input, system_user_prompt, model, temperature, session_id, on_queue_position)
+    return chunks if stream else "".join(chunks)
+
+def stream_answer(user_input: str, system_user_prompt: str, model: str, temperature: float, session_id: str, on_queue_position):
+    collection = connection_mongodb()
+
+    # Perguntas dos botões de sugestão já têm resposta pronta para a geração atual da base
+    prewarmed = find_prewarmed_answer(collection, user_input)
+    if prewarmed:
+        yield prewarmed['answer']
+        return
 
+    # Prompt, roteamento por membro e BM25 rodam em paralelo; fechar o gerador (usuário saiu)
+    # ou uma nova pergunta da mesma sessão cancela o que estiver pendente
+    pipeline = RequestPipeline(collection, user_input, session_id=session_id)
     try:
-        completion = groq_client.chat.completions.create(
-            model=model,
-            messages=[{
-                "role": "user", 
-                "content": final_prompt
-            }],
-            stream=stream,
-            temperature=temperature
-        )
-        return completion.choices[0].message.content
-    except Exception as e:
-        return f"❌ Erro ao gerar resposta: {str(e)}"
+        if system_user_prompt is None:
+            prepared = pipeline.prepare(lambda question: load_prompt_from_yaml("system_user_prompt", question))
+        else:
+            prepared = pipeline.prepare(lambda question: [{"role": "user", "content": system_user_prompt}])
+        if prepared['cached_answer']:
+            yield prepared['cached_answer']
+            return
+
+        retrieved_documents = prepared['documents']
+        prompt_messages = prepared['system_user_prompt'] or [{"role": "user", "content": user_input}]
+        messages, prompt_stats = build_final_prompt(retrieved_documents, prompt_messages)
+        st.session_state.last_prompt_stats = prompt_stats
+
+        # Respostas prontas não entram na fila; só a chamada ao GROQ espera a vez
+        pieces = []
+        try:
+            with get_admission_controller().admit(session_id, on_queue_position):
+                for piece in request_completion(messages, model, stream=True, temperature=temperature):
+                    pieces.append(piece)
+                    yield piece
+        except Overloaded as e:
+            print(f"Pergunta recusada: {e}")
+            yield "⏳ Muitas perguntas ao mesmo tempo agora. Tente de novo em alguns instantes!"
+            return
+        except Exception as e:
+            yield f"❌ Erro ao gerar resposta: {str(e)}"
+            return
+
+        answer_cache = prepared['answer_cache']
+        if answer_cache is not None and prepared['query_embedding'] is not None:
+            answer_cache.store(user_input, prepared['query_embedding'], "".join(pieces), retrieved_documents, prepared['cache_version'])
+    except RequestCancelled:
+        # A sessão mandou outra pergunta enquanto esta era preparada
+        return
+    finally:
+        pipeline.cancel()
+
+def answer_suggestion(question: str):
+    """Resposta e contexto de uma pergunta de sugestão, calculados em segundo plano"""
+    retrieved_documents = retrieve_documents(connection_mongodb(), question)
+    messages, _ = build_final_prompt(retrieved_documents, load_prompt_from_yaml("system_user_prompt", question))
+    # Divide a fila com as sessões em rodízio, sem passar na frente de quem está esperando
+    with get_admission_controller().admit("suggestions"):
+        answer = request_completion(messages, ANSWER_MODEL, temperature=0.8)
+    return answer, [doc['text'] for doc in retrieved_documents]
+
+# Respostas das sugestões recalculadas em segundo plano sempre que a base é reindexada
+start_suggestion_refresh(connection_mongodb(), [item['question'] for item in SUGGESTIONS], answer_suggestion)
 
 
 # Header principal
@@ -337,19 +407,10 @@ with col1:
     # Sugestões de perguntas
     if not st.session_state.chat_history:
         st.markdown("**💡 Sugestões de perguntas:**")
-        suggestions_col1, suggestions_col2, suggestions_col3 = st.columns(3)
-        
-        with suggestions_col1:
-            if st.button("Quem são os membros da equipe?", key="sug1"):
-                st.session_state.suggested_question = "Quem são os membros da equipe PingPoli?"
-        
-        with suggestions_col2:
-            if st.button("Horários de treino", key="sug2"):
-                st.session_state.suggested_question = "Quais são os horários de treino da equipe?"
-        
-        with suggestions_col3:
-            if st.button("Próximos campeonatos", key="sug3"):
-                st.session_state.suggested_question = "Quais são os próximos campeonatos da equipe?"
+        for i, (column, suggestion) in enumerate(zip(st.columns(len(SUGGESTIONS)), SUGGESTIONS), start=1):
+            with column:
+                if st.button(suggestion["label"], key=f"sug{i}"):
+                    st.session_state.suggested_question = suggestion["question"]
     
     # Usando formulário para capturar Enter
     with st.form(key=f"chat_form_{st.session_state.input_key}", clear_on_submit=True):
@@ -404,6 +465,9 @@ with col2:
     # Configurações (removidas - usando apenas llama padrão)
     # st.markdown("### ⚙️ Configurações")
     
+    if not is_ready():
+        st.caption("⏳ Carregando o modelo de busca; a primeira resposta pode demorar um pouco mais.")
+
     # Informações da equipe
     st.markdown("### 🏓 Sobre o PingPoli")
     st.markdown("""
@@ -419,7 +483,7 @@ if send_button and user_input.strip():
     
     # Mostrar indicador de digitação
     typing_placeholder = st.empty()
-    typing_placeholder.markdown("""
+    typing_indicator = """
     <div class="typing-indicator">
         🏓 PingPoli Agent está digitando
         <div class="typing-dots">
@@ -428,27 +492,33 @@ if send_button and user_input.strip():
             <span></span>
         </div>
     </div>
-    """, unsafe_allow_html=True)
-    
-    # Gerar resposta (usando modelo fixo)
-    system_user_prompt = load_prompt_from_yaml("system_user_prompt", user_input)
-    answer = generate_answer(user_input, system_user_prompt, model="meta-llama/llama-4-maverick-17b-128e-instruct", temperature=0.8)
-    
-    # Remover indicador de digitação
-    typing_placeholder.empty()
+    """
+    typing_placeholder.markdown(typing_indicator, unsafe_allow_html=True)
+    
+    # Gerar resposta (usando modelo fixo) e exibi-la enquanto o GROQ envia os tokens;
+    # o primeiro pedaço substitui o indicador de digitação
+    def show_queue_position(position: int):
+        # Posição 0: a pergunta saiu da fila e o indicador de digitação volta
+        if not position:
+            typing_placeholder.markdown(typing_indicator, unsafe_allow_html=True)
+            return
+        typing_placeholder.markdown(f"""
+        <div class="typing-indicator">
+            ⏳ Muitas perguntas ao mesmo tempo: você é o {position}º da fila
+        </div>
+        """, unsafe_allow_html=True)
+
+    answer_chunks = generate_answer(user_input, model=ANSWER_MODEL, stream=True, temperature=0.8,
+                                    session_id=st.session_state.session_id, on_queue_position=show_queue_position)
+    answer = stream_text_response(answer_chunks, typing_placeholder)
     
     # Adicionar ao histórico
     st.session_state.chat_history.append((user_input, answer))
     
-    # Mostrar nova resposta com animação
-    response_placeholder = st.empty()
-    animate_text_response(answer, response_placeholder)
-    
     # Resetar o input incrementando a key
     st.session_state.input_key += 1
     
     # Recarregar para mostrar histórico atualizado
-    time.sleep(1)
     st.rerun()
 
 # Footer
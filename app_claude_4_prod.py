@@ -1,12 +1,15 @@
 import streamlit as st
-import time
-import yaml
 from datetime import datetime
-import numpy as np
-from groq import Groq
-from pymongo import MongoClient
-from sentence_transformers import SentenceTransformer
-from scipy.spatial.distance import cosine
+from uuid import uuid4
+from admission import Overloaded, get_admission_controller
+from context_builder import build_context, log_prompt_stats
+from embedding_model import is_ready, start_warmup
+from knowledge_base import get_mongo_client, resolve_collection
+from llm_client import get_llm_client
+from prompt_layout import CONTEXT_INSTRUCTIONS, build_chat_messages, count_message_tokens
+from prompt_registry import get_prompt_registry
+from request_pipeline import RequestCancelled, RequestPipeline
+from vector_index import set_retrieval_mode
 
 # ==============================================================================
 # 1. CONFIGURAÇÃO INICIAL E ESTILOS
@@ -121,7 +124,8 @@ load_css()
 try:
     GROQ_API_KEY = st.secrets["GROQ_API_KEY"]
     MONGO_URI = st.secrets["MONGO_URI"]
-    groq_client = Groq(api_key=GROQ_API_KEY)
+    RETRIEVAL_MODE = st.secrets.get("RETRIEVAL_MODE", "client")
+    groq_client = get_llm_client(GROQ_API_KEY, st.secrets.get("GROQ_BASE_URL"))
 except (KeyError, FileNotFoundError):
     st.error("🚨 API Key do GROQ ou URI do MongoDB não encontradas! Verifique seus segredos.")
     st.stop()
@@ -133,84 +137,93 @@ if "total_questions" not in st.session_state:
     st.session_state.total_questions = 0
 if "session_start" not in st.session_state:
     st.session_state.session_start = datetime.now()
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid4().hex
 
 # ==============================================================================
 # 2. FUNÇÕES DE CACHE (Performance)
 # ==============================================================================
 
 @st.cache_resource
-def get_sentence_transformer_model():
-    """Carrega e armazena em cache o modelo de embedding."""
-    return SentenceTransformer('PORTULAN/serafim-100m-portuguese-pt-sentence-encoder-ir')
+def get_mongo_database():
+    """Conecta ao MongoDB e retorna o banco, armazenando a conexão em cache."""
+    mongo_client = get_mongo_client(MONGO_URI)
+    return mongo_client["pingpoli"]
 
-@st.cache_resource
 def get_mongo_collection():
-    """Conecta ao MongoDB e retorna a coleção, armazenando a conexão em cache."""
-    mongo_client = MongoClient(MONGO_URI)
-    db = mongo_client["pingpoli"]
-    return db["members_informations"]
+    """Coleção da geração ativa da base; o ponteiro é relido a cada execução (com TTL curto)."""
+    collection = resolve_collection(get_mongo_database(), "members_informations")
+    set_retrieval_mode(collection, RETRIEVAL_MODE)
+    return collection
 
 # ==============================================================================
 # 3. FUNÇÕES DE BACKEND (Lógica do Agente)
 # ==============================================================================
 
-def search_for_documents(input_text_embedding: np.ndarray, collection, k: int = 5) -> list[str]:
-    """Busca os k documentos mais similares no MongoDB."""
-    similarities = []
-    for doc in collection.find({}, {'_id': 0, 'text': 1, 'embedding': 1}):
-        if 'embedding' in doc and doc['embedding'] and 'text' in doc:
-            cos_sim = 1 - cosine(input_text_embedding, doc['embedding'])
-            similarities.append((cos_sim, doc['text']))
-    
-    # Ordena pela similaridade (decrescente) e pega os top k
-    similarities.sort(key=lambda x: x[0], reverse=True)
-    
-    return [text for sim, text in similarities[:k]]
-
-def load_system_prompt(user_input: str) -> str:
-    """Carrega o prompt do sistema a partir de um arquivo YAML."""
+def load_system_prompt(user_input: str) -> list:
+    """Mensagens do prompt do arquivo YAML (interpretado uma vez e recarregado quando muda)."""
     try:
-        with open("prompts.yaml", "r", encoding="utf-8") as file:
-            prompts = yaml.safe_load(file)
-        return prompts.get("system_user_prompt", "").format(user_input=user_input)
-    except Exception:
-        # Fallback caso o arquivo de prompts não exista ou tenha erro
-        return f"Responda à seguinte pergunta de forma detalhada e útil: {user_input}"
-
-def generate_llm_response(user_input: str, model, collection) -> str:
-    """Pipeline completo: embedding, busca RAG e geração de resposta com LLM."""
-    
-    # 1. Gerar embedding da pergunta do usuário
-    input_embedding = model.encode(user_input)
-    
-    # 2. Buscar documentos relevantes (contexto RAG)
-    retrieved_docs = search_for_documents(input_embedding, collection)
-    context = "\n\n---\n\n".join(retrieved_docs)
-    
-    # 3. Carregar e formatar o prompt final
-    system_user_prompt = load_system_prompt(user_input)
-    final_prompt = f"""
-    Você é um assistente de IA especialista. Use o CONTEXTO fornecido abaixo para responder à PERGUNTA do usuário de forma precisa e factual.
-
-    CONTEXTO:
-    {context}
-
-    PERGUNTA:
-    {system_user_prompt}
+        return get_prompt_registry().render_messages("system_user_prompt", user_input=user_input)
+    except KeyError:
+        # Fallback caso nenhuma versão válida do arquivo de prompts tenha sido carregada
+        return [
+            {"role": "system", "content": "Responda à pergunta de forma detalhada e útil."},
+            {"role": "user", "content": user_input},
+        ]
+
+def generate_llm_response(user_input: str, collection, on_queue_position=None):
+    """Pipeline completo: embedding, busca RAG e geração de resposta com LLM.
+
+    Gerador com os pedaços da resposta, entregues à medida que a Groq os envia.
+    Fechar o gerador (usuário saiu ou mandou outra pergunta) cancela o trabalho pendente.
+    A chamada à Groq espera a vez na fila do processo; `on_queue_position(posição)` é
+    chamado enquanto ela espera (0 quando sai da fila).
     """
-
-    # 4. Chamar a API da Groq
+    pipeline = RequestPipeline(collection, user_input, session_id=st.session_state.session_id)
     try:
-        completion = groq_client.chat.completions.create(
-            model="meta-llama/llama-4-maverick-17b-128e-instruct",
-            messages=[{"role": "user", "content": final_prompt}],
-            temperature=0.7,
-            stream=False
-        )
-        return completion.choices[0].message.content
-    except Exception as e:
-        st.error(f"❌ Erro ao comunicar com a API da Groq: {e}")
-        return "Desculpe, não consegui processar sua solicitação no momento."
+        # 1. Em paralelo: prompt, roteamento por membro e BM25; o embedding só quando há busca densa;
+        #    perguntas iguais ou parecidas com uma já respondida reaproveitam a resposta.
+        prepared = pipeline.prepare(load_system_prompt)
+        if prepared['cached_answer']:
+            yield prepared['cached_answer']
+            return
+
+        # 2. Montar as mensagens: system fixo (diretrizes + instruções) primeiro, para o cache
+        #    de prompt do provedor, e o CONTEXTO (dentro do orçamento de tokens) e a PERGUNTA no fim
+        context, prompt_stats = build_context(prepared['documents'])
+        prompt_messages = prepared['system_user_prompt'] or [{"role": "user", "content": user_input}]
+        messages = build_chat_messages(prompt_messages, CONTEXT_INSTRUCTIONS, context)
+        prompt_stats['prompt_tokens'] = count_message_tokens(messages)
+        log_prompt_stats(prompt_stats)
+        st.session_state.last_prompt_stats = prompt_stats
+
+        # 3. Chamar a API da Groq, repassando os tokens assim que chegam; só esta etapa
+        #    espera a vez na fila (justa entre as sessões do processo)
+        pieces = []
+        try:
+            with get_admission_controller().admit(st.session_state.session_id, on_queue_position):
+                # Timeouts, novas tentativas em 429/5xx, hedge e modelo reserva ficam no llm_client
+                chunks = groq_client.complete(messages, "meta-llama/llama-4-maverick-17b-128e-instruct", temperature=0.7, stream=True)
+                for piece in chunks:
+                    pieces.append(piece)
+                    yield piece
+        except Overloaded as e:
+            print(f"Pergunta recusada: {e}")
+            yield "⏳ Muitas perguntas ao mesmo tempo agora. Tente de novo em alguns instantes!"
+            return
+        except Exception as e:
+            st.error(f"❌ Erro ao comunicar com a API da Groq: {e}")
+            yield "Desculpe, não consegui processar sua solicitação no momento."
+            return
+
+        answer_cache = prepared['answer_cache']
+        if answer_cache is not None and prepared['query_embedding'] is not None:
+            answer_cache.store(user_input, prepared['query_embedding'], "".join(pieces), prepared['documents'], prepared['cache_version'])
+    except RequestCancelled:
+        # A sessão mandou outra pergunta enquanto esta era preparada
+        return
+    finally:
+        pipeline.cancel()
 
 # ==============================================================================
 # 4. COMPONENTES DE UI (Layout do Aplicativo)
@@ -242,6 +255,9 @@ def setup_sidebar():
             </div>
             """, unsafe_allow_html=True)
 
+        if not is_ready():
+            st.caption("⏳ Carregando o modelo de busca; a primeira resposta pode demorar um pouco mais.")
+
         st.markdown("<h2 class='sidebar-header'>🛡️ Nosso Compromisso</h2>", unsafe_allow_html=True)
         st.info("""
         O Agente IA do PingPoli tem um único propósito: fornecer informações 
@@ -262,8 +278,8 @@ def setup_sidebar():
 # 5. LÓGICA PRINCIPAL DO APLICATIVO
 # ==============================================================================
 
-# Carregar recursos cacheados
-embedding_model = get_sentence_transformer_model()
+# Carregar recursos: o modelo de embedding aquece em segundo plano, uma vez por processo
+start_warmup()
 mongo_collection = get_mongo_collection()
 
 # Configurar a barra lateral
@@ -296,20 +312,18 @@ if prompt := st.chat_input("Faça sua pergunta sobre o PingPoli..."):
     with st.chat_message("user", avatar="🙋‍♂️"):
         st.markdown(prompt)
 
-    # Mostrar indicador de "digitando" e gerar resposta
+    # Exibir a resposta enquanto a Groq envia os tokens
     with st.chat_message("assistant", avatar="🏓"):
-        with st.spinner("🏓 PingPoli Agent está pensando..."):
-            response = generate_llm_response(prompt, embedding_model, mongo_collection)
-            
-            # Simular digitação para uma melhor UX
-            message_placeholder = st.empty()
-            full_response = ""
-            for chunk in response.split():
-                full_response += chunk + " "
-                time.sleep(0.05)
-                message_placeholder.markdown(full_response + "▌")
-            message_placeholder.markdown(full_response)
-            
+        queue_status = st.empty()
+
+        def show_queue_position(position: int):
+            if position:
+                queue_status.caption(f"⏳ Muitas perguntas ao mesmo tempo: você é o {position}º da fila")
+            else:
+                queue_status.empty()
+
+        response = st.write_stream(generate_llm_response(prompt, mongo_collection, show_queue_position))
+
     # Adicionar resposta do bot ao histórico
     st.session_state.chat_history.append({"role": "assistant", "content": response})
 
@@ -0,0 +1,90 @@
+import os
+import re
+
+# Tamanho dos trechos e sobreposição entre trechos vizinhos, em palavras
+CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', '120'))
+CHUNK_OVERLAP = int(os.getenv('CHUNK_OVERLAP', '30'))
+
+# Quantos trechos vizinhos (antes e depois) são anexados a cada trecho recuperado
+CHUNK_NEIGHBOURS = int(os.getenv('CHUNK_NEIGHBOURS', '0'))
+
+PASSAGE_FIELDS = {'text': 1, 'file_name': 1, 'chunk_index': 1, 'start': 1, 'end': 1}
+
+
+def chunk_text(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> list[tuple[int, int]]:
+    """Divide o texto em trechos de `size` palavras com `overlap` palavras repetidas.
+
+    Retorna os offsets (início, fim) de cada trecho em caracteres do texto original.
+    """
+    words = [match.span() for match in re.finditer(r'\S+', text)]
+    if not words:
+        return [(0, len(text))]
+
+    step = max(size - overlap, 1)
+    spans = []
+    for first in range(0, len(words), step):
+        last = min(first + size, len(words)) - 1
+        spans.append((words[first][0], words[last][1]))
+        if last == len(words) - 1:
+            break
+    return spans
+
+
+def merge_chunks(chunks: list[dict]) -> str:
+    """Reconstrói o texto contínuo de trechos do mesmo arquivo, sem repetir a sobreposição."""
+    chunks = sorted(chunks, key=lambda chunk: chunk.get('chunk_index', 0))
+    text = chunks[0]['text']
+    end = chunks[0].get('end', len(text))
+    for chunk in chunks[1:]:
+        if 'start' not in chunk or chunk['start'] > end:
+            text += '\n\n' + chunk['text']
+        else:
+            text += chunk['text'][end - chunk['start']:]
+        end = max(end, chunk.get('end', end))
+    return text
+
+
+def expand_with_neighbours(collection, passages: list[dict], window: int = None) -> list[dict]:
+    """Anexa a cada trecho recuperado seus `window` vizinhos no mesmo arquivo.
+
+    Trechos do mesmo arquivo que acabam se sobrepondo são fundidos numa única passagem,
+    que fica na posição do trecho mais bem pontuado.
+    """
+    window = CHUNK_NEIGHBOURS if window is None else window
+    if window <= 0 or not passages:
+        return passages
+
+    wanted = {}
+    for passage in passages:
+        if passage.get('chunk_index') is None:
+            continue
+        indexes = wanted.setdefault(passage['file_name'], set())
+        indexes.update(range(passage['chunk_index'] - window, passage['chunk_index'] + window + 1))
+
+    neighbours = {}
+    if wanted:
+        query = {'$or': [{'file_name': file, 'chunk_index': {'$in': sorted(indexes)}} for file, indexes in wanted.items()]}
+        for chunk in collection.find(query, PASSAGE_FIELDS):
+            neighbours[(chunk['file_name'], chunk['chunk_index'])] = chunk
+
+    # Cada grupo é [arquivo, índices dos trechos, passagem]; grupos sobrepostos do mesmo arquivo se fundem
+    groups = []
+    for passage in passages:
+        if passage.get('chunk_index') is None:
+            groups.append([None, None, passage])
+            continue
+        file_name = passage['file_name']
+        indexes = {i for i in range(passage['chunk_index'] - window, passage['chunk_index'] + window + 1)
+                   if (file_name, i) in neighbours}
+        group = next((g for g in groups if g[0] == file_name and g[1] & indexes), None)
+        if group is not None:
+            group[1] |= indexes
+        else:
+            groups.append([file_name, indexes, passage])
+
+    merged = []
+    for file_name, indexes, passage in groups:
+        if indexes:
+            passage = {**passage, 'text': merge_chunks([neighbours[(file_name, i)] for i in sorted(indexes)])}
+        merged.append(passage)
+    return merged
@@ -0,0 +1,123 @@
+import logging
+import os
+import re
+
+# Separador entre os trechos do CONTEXTO no prompt
+PASSAGE_SEPARATOR = "\n\n---\n\n"
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+_encoding = None
+
+
+def get_encoding():
+    """Tokenizador BPE local (cl100k_base, próximo do usado pelos modelos Llama da Groq), se instalado."""
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        _encoding = tiktoken.get_encoding(os.getenv('CONTEXT_TOKENIZER', 'cl100k_base'))
+    return _encoding
+
+
+# Sem tiktoken: palavras, números e pontuação contam como um token cada, e palavras
+# longas como um token a cada 4 caracteres, o que fica próximo do BPE em português
+_PIECE_PATTERN = re.compile(r'\w{1,4}|[^\w\s]')
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(_PIECE_PATTERN.findall(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Início do texto com no máximo `max_tokens` tokens, cortado numa fronteira de palavra."""
+    encoding = get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        truncated = encoding.decode(tokens[:max_tokens])
+    else:
+        pieces = list(_PIECE_PATTERN.finditer(text))
+        if len(pieces) <= max_tokens:
+            return text
+        truncated = text[:pieces[max_tokens].start()]
+    # Não deixa meia palavra no fim do trecho
+    cut = truncated.rstrip()
+    space = cut.rfind(' ')
+    return (cut[:space] if space > len(cut) // 2 else cut) + ' [...]'
+
+
+def context_settings() -> dict:
+    return {
+        # Tokens reservados para os trechos do CONTEXTO (sem contar o prompt do sistema)
+        'budget': int(os.getenv('CONTEXT_TOKEN_BUDGET', '1500')),
+        # Quantos trechos a busca devolve no máximo; o k efetivo sai dos cortes abaixo
+        'max_passages': int(os.getenv('CONTEXT_MAX_PASSAGES', '8')),
+        # Similaridade mínima absoluta e relativa ao melhor trecho para entrar no CONTEXTO
+        'min_similarity': float(os.getenv('CONTEXT_MIN_SIMILARITY', '0.2')),
+        'relative_similarity': float(os.getenv('CONTEXT_RELATIVE_SIMILARITY', '0.5')),
+        # Abaixo disso, um trecho que não cabe inteiro é descartado em vez de cortado
+        'min_passage_tokens': int(os.getenv('CONTEXT_MIN_PASSAGE_TOKENS', '64')),
+    }
+
+
+def build_context(documents: list[dict], settings: dict = None) -> tuple[str, dict]:
+    """Monta o CONTEXTO dentro do orçamento de tokens, na ordem de similaridade.
+
+    Trechos abaixo do corte de similaridade ficam de fora (k adaptativo); os demais
+    entram enquanto couberem, e o primeiro que não cabe é cortado se ainda sobrar
+    espaço útil. O melhor trecho sempre entra, cortado se preciso. Retorna o texto
+    e as estatísticas da montagem (tokens usados, orçamento, trechos usados/descartados).
+    """
+    settings = settings or context_settings()
+    ranked = sorted(documents, key=lambda doc: doc.get('similarity', 0.0), reverse=True)
+    if ranked:
+        cutoff = max(settings['min_similarity'], ranked[0].get('similarity', 0.0) * settings['relative_similarity'])
+        candidates = ranked[:1] + [doc for doc in ranked[1:] if doc.get('similarity', 0.0) >= cutoff]
+    else:
+        candidates = []
+
+    separator_tokens = count_tokens(PASSAGE_SEPARATOR)
+    passages = []
+    used = 0
+    truncated = 0
+    for doc in candidates:
+        remaining = settings['budget'] - used - (separator_tokens if passages else 0)
+        tokens = count_tokens(doc['text'])
+        if tokens <= remaining:
+            passages.append(doc['text'])
+            used += tokens + (separator_tokens if len(passages) > 1 else 0)
+            continue
+        if remaining >= settings['min_passage_tokens'] or not passages:
+            text = truncate_to_tokens(doc['text'], max(remaining, 0))
+            passages.append(text)
+            used += count_tokens(text) + (separator_tokens if len(passages) > 1 else 0)
+            truncated += 1
+        break
+
+    stats = {
+        'budget': settings['budget'],
+        'context_tokens': used,
+        'retrieved': len(documents),
+        'above_cutoff': len(candidates),
+        'used': len(passages),
+        'truncated': truncated,
+        'dropped': len(documents) - len(passages),
+    }
+    return PASSAGE_SEPARATOR.join(passages), stats
+
+
+def log_prompt_stats(stats: dict):
+    # Uma linha por pergunta: fica no nível debug para não poluir a saída dos apps
+    logger.debug(
+        "Contexto: %s/%s tokens, %s de %s trechos (%s cortado(s)), prompt com %s tokens",
+        stats['context_tokens'], stats['budget'], stats['used'], stats['retrieved'],
+        stats['truncated'], stats.get('prompt_tokens', '?'),
+    )
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem trava entre processos, só um processo deve gravar no arquivo
+    fcntl = None
+
+# Quantas posições da tabela em disco são testadas a partir da posição do hash
+DISK_PROBES = 8
+
+# Tamanho da chave (sha1); uma posição com a chave toda zerada está livre
+KEY_SIZE = 20
+EMPTY_KEY = bytes(KEY_SIZE)
+
+
+def normalize_query(text: str) -> str:
+    """Chave do cache: mesma pergunta com caixa ou espaços diferentes vira a mesma chave."""
+    return ' '.join(unicodedata.normalize('NFC', text).casefold().split())
+
+
+def query_key(text: str) -> bytes:
+    return hashlib.sha1(normalize_query(text).encode('utf-8')).digest()
+
+
+def disk_file_name(path: str, model_id: str, slots: int) -> str:
+    """Arquivo da tabela em disco: cada modelo (e tamanho de tabela) tem o seu.
+
+    Trocar o modelo ou o backend (onnx/torch) passa a usar outro arquivo, em vez de
+    recriar um que outros processos ainda têm mapeado com o layout antigo.
+    """
+    model = re.sub(r'[^\w.-]', '_', model_id)
+    return f'{path}.{model}.{slots}'
+
+
+class DiskEmbeddingStore:
+    """Tabela hash de tamanho fixo num arquivo memory-mapped, compartilhada entre processos.
+
+    Cada posição guarda a chave (sha1 da pergunta normalizada) e o vetor. As gravações
+    são serializadas entre processos por uma trava (flock) no arquivo `.lock`; dentro
+    dela a chave é zerada, o vetor gravado e só então a chave nova escrita. A leitura
+    não trava: confere a chave de novo depois de copiar o vetor, de modo que um leitor
+    nunca devolve uma posição sendo sobrescrita.
+    Quando as posições testadas estão todas ocupadas, a do próprio hash é substituída.
+    """
+
+    def __init__(self, path: str, dim: int, slots: int, model_id: str):
+        self.path = path
+        self.slots = slots
+        dtype = np.dtype([('key', 'u1', (KEY_SIZE,)), ('vector', '<f4', (dim,))])
+        meta = {'model': model_id, 'dim': dim, 'slots': slots}
+
+        meta_path = f'{path}.json'
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as file:
+                valid = json.load(file) == meta and os.path.getsize(path) == dtype.itemsize * slots
+        except (OSError, ValueError):
+            valid = False
+        if not valid:
+            # Arquivo ausente, truncado ou de outra dimensão: um arquivo novo substitui o
+            # antigo de uma vez, sem reescrever o que outros processos ainda têm mapeado
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            tmp_path = f'{path}.tmp-{os.getpid()}'
+            np.memmap(tmp_path, dtype=dtype, mode='w+', shape=(slots,)).flush()
+            os.replace(tmp_path, path)
+            with open(f'{meta_path}.tmp-{os.getpid()}', 'w', encoding='utf-8') as file:
+                json.dump(meta, file)
+            os.replace(f'{meta_path}.tmp-{os.getpid()}', meta_path)
+        self.table = np.memmap(path, dtype=dtype, mode='r+', shape=(slots,))
+        self._lock_file = open(f'{path}.lock', 'a+b') if fcntl is not None else None
+
+    def _positions(self, key: bytes):
+        start = int.from_bytes(key[:8], 'little') % self.slots
+        return [(start + probe) % self.slots for probe in range(DISK_PROBES)]
+
+    def _key_at(self, position: int) -> bytes:
+        return self.table['key'][position].tobytes()
+
+    def get(self, key: bytes):
+        for position in self._positions(key):
+            stored = self._key_at(position)
+            if stored == key:
+                vector = np.array(self.table['vector'][position])
+                if self._key_at(position) == key:
+                    vector.setflags(write=False)
+                    return vector
+            elif stored == EMPTY_KEY:
+                return None
+        return None
+
+    def put(self, key: bytes, vector):
+        # Dois processos gravando a mesma posição ao mesmo tempo deixariam a chave de um
+        # com o vetor do outro, e a conferência do leitor não perceberia
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            positions = self._positions(key)
+            target = next((p for p in positions if self._key_at(p) in (EMPTY_KEY, key)), positions[0])
+            self.table['key'][target] = 0
+            self.table['vector'][target] = vector
+            self.table['key'][target] = np.frombuffer(key, dtype=np.uint8)
+        finally:
+            if self._lock_file is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+
+class QueryEmbeddingCache:
+    """Cache LRU pergunta normalizada -> embedding, com espelho opcional em disco.
+
+    A memória guarda as `max_size` perguntas mais recentes; o arquivo em disco
+    sobrevive a reinícios e é lido pelos outros processos do mesmo servidor.
+    """
+
+    def __init__(self, max_size: int, disk_path: str = None, disk_slots: int = 65536, model_id: str = ''):
+        self.max_size = max_size
+        self.disk_path = disk_file_name(disk_path, model_id, disk_slots) if disk_path else None
+        self.disk_slots = disk_slots
+        self.model_id = model_id
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._disk = None
+        self._lock = threading.Lock()
+
+    def _disk_store(self, dim: int = None):
+        if self._disk is None and self.disk_path:
+            if dim is None:
+                # Antes do primeiro put a dimensão vem do arquivo gravado por outro processo
+                try:
+                    with open(f'{self.disk_path}.json', 'r', encoding='utf-8') as file:
+                        meta = json.load(file)
+                except (OSError, ValueError):
+                    return None
+                if meta.get('model') != self.model_id:
+                    return None
+                dim = meta['dim']
+            self._disk = DiskEmbeddingStore(self.disk_path, dim, self.disk_slots, self.model_id)
+        return self._disk
+
+    def get(self, text: str):
+        key = query_key(text)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector
+            disk = self._disk_store()
+            vector = disk.get(key) if disk is not None else None
+            if vector is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, vector)
+            return vector
+
+    def put(self, text: str, vector):
+        key = query_key(text)
+        vector = np.asarray(vector, dtype=np.float32)
+        vector.setflags(write=False)
+        with self._lock:
+            self._remember(key, vector)
+            disk = self._disk_store(len(vector))
+            if disk is not None:
+                disk.put(key, vector)
+        return vector
+
+    def _remember(self, key: bytes, vector):
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
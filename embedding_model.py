@@ -0,0 +1,353 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from admission import get_admission_controller
+from embedding_cache import QueryEmbeddingCache
+
+MODEL_NAME = 'PORTULAN/serafim-100m-portuguese-pt-sentence-encoder-ir'
+
+ENCODER_BACKENDS = ('torch', 'onnx')
+
+# Texto curto codificado no aquecimento: força a alocação dos pesos e dos kernels
+WARMUP_SENTENCES = ['Quem são os membros da equipe PingPoli?']
+
+# Frases comparadas entre o encoder ONNX e o PyTorch antes de o ONNX ser usado
+VALIDATION_SENTENCES = [
+    'Quem são os membros da equipe PingPoli?',
+    'Quais são os horários de treino da equipe?',
+    'Quais são os próximos campeonatos da equipe?',
+    'Fale sobre o Shigueru',
+    'Qual é o estilo de jogo do capitão do time?',
+    'Nome: Ana\nPosição: atacante, joga com borracha lisa no forehand.',
+    'A equipe treina às terças e quintas no ginásio da Poli.',
+    'tênis de mesa',
+]
+
+_model = None
+_load_error = None
+_ready = threading.Event()
+# Segurado durante toda a carga do modelo; o resto do módulo usa _lock, que nunca espera pela carga
+_load_lock = threading.Lock()
+_lock = threading.Lock()
+_warmup_thread = None
+
+
+def model_settings() -> dict:
+    """Configuração do encoder lida do ambiente (após o load_dotenv dos apps)."""
+    return {
+        'name': os.getenv('EMBEDDING_MODEL', MODEL_NAME),
+        # Vazio: o sentence-transformers escolhe (cuda se disponível, senão cpu)
+        'device': os.getenv('EMBEDDING_DEVICE') or None,
+        # 0: mantém o padrão do torch
+        'threads': int(os.getenv('EMBEDDING_THREADS', '0')),
+        # 0: mantém o limite do próprio modelo
+        'max_seq_length': int(os.getenv('EMBEDDING_MAX_SEQ_LENGTH', '0')),
+        # 'onnx' roda o encoder no onnxruntime (CPU), com quantização int8 opcional
+        'backend': os.getenv('EMBEDDING_BACKEND', 'torch'),
+        # Configuração da quantização dinâmica int8 ('avx2', 'avx512_vnni', 'arm64'); vazio: sem quantizar
+        'quantization': os.getenv('EMBEDDING_QUANTIZATION', ''),
+        'onnx_dir': os.getenv('EMBEDDING_ONNX_DIR', './data/onnx'),
+        # Similaridade de cosseno mínima com o modelo PyTorch, para os vetores já gravados continuarem válidos
+        'min_cosine': float(os.getenv('EMBEDDING_MIN_COSINE', '0.99')),
+        # Janela (ms) em que perguntas simultâneas de sessões diferentes são agrupadas; 0 desliga
+        'batch_window_ms': float(os.getenv('EMBEDDING_BATCH_WINDOW_MS', '5')),
+        'max_batch_size': int(os.getenv('EMBEDDING_MAX_BATCH_SIZE', '32')),
+        # Cache pergunta -> embedding: entradas em memória (0 desliga) e arquivo em disco opcional
+        'cache_size': int(os.getenv('EMBEDDING_CACHE_SIZE', '1024')),
+        # Prefixo do arquivo em disco; o nome final leva o modelo e o número de posições
+        'cache_path': os.getenv('EMBEDDING_CACHE_PATH', ''),
+        'cache_disk_slots': int(os.getenv('EMBEDDING_CACHE_DISK_SLOTS', '65536')),
+    }
+
+
+def model_id(settings: dict) -> str:
+    """Identifica os vetores produzidos: mudar o modelo ou o backend invalida os caches."""
+    if settings['backend'] == 'onnx':
+        return f"{settings['name']}:{onnx_file_name(settings)}"
+    return settings['name']
+
+
+def onnx_model_dir(settings: dict) -> str:
+    return os.path.join(settings['onnx_dir'], re.sub(r'[^\w.-]', '_', settings['name']))
+
+
+def onnx_file_name(settings: dict) -> str:
+    if settings['quantization']:
+        return f"onnx/model_qint8_{settings['quantization']}.onnx"
+    return 'onnx/model.onnx'
+
+
+def load_torch_model(settings: dict) -> SentenceTransformer:
+    if settings['threads'] > 0:
+        import torch
+        torch.set_num_threads(settings['threads'])
+    return SentenceTransformer(settings['name'], device=settings['device'])
+
+
+def load_onnx_model(settings: dict) -> SentenceTransformer:
+    """Encoder exportado em ONNX rodando no onnxruntime, com a mesma interface `encode()`."""
+    import onnxruntime
+
+    session_options = onnxruntime.SessionOptions()
+    if settings['threads'] > 0:
+        session_options.intra_op_num_threads = settings['threads']
+    session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    return SentenceTransformer(
+        onnx_model_dir(settings),
+        backend='onnx',
+        device='cpu',
+        model_kwargs={
+            'file_name': onnx_file_name(settings),
+            'provider': 'CPUExecutionProvider',
+            'session_options': session_options,
+        },
+    )
+
+
+def compare_encoders(candidate, reference, sentences: list = None) -> float:
+    """Menor similaridade de cosseno entre os vetores dos dois encoders para as mesmas frases."""
+    sentences = sentences or VALIDATION_SENTENCES
+    a = np.asarray(candidate.encode(sentences), dtype=np.float32)
+    b = np.asarray(reference.encode(sentences), dtype=np.float32)
+    cosines = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    return float(cosines.min())
+
+
+def export_onnx_model(settings: dict = None, sentences: list = None) -> dict:
+    """Exporta o encoder para ONNX (e quantiza, se configurado) e o valida contra o PyTorch.
+
+    O resultado da validação fica em `validation.json` ao lado do modelo exportado;
+    os apps só usam o arquivo ONNX se ele tiver passado no limite de cosseno.
+    """
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    settings = settings or model_settings()
+    model_dir = onnx_model_dir(settings)
+    if not os.path.exists(os.path.join(model_dir, 'onnx', 'model.onnx')):
+        # Sem o arquivo ONNX, o sentence-transformers exporta o modelo na carga
+        SentenceTransformer(settings['name'], backend='onnx', device='cpu').save_pretrained(model_dir)
+    if settings['quantization'] and not os.path.exists(os.path.join(model_dir, onnx_file_name(settings))):
+        onnx_model = SentenceTransformer(model_dir, backend='onnx', device='cpu')
+        export_dynamic_quantized_onnx_model(onnx_model, settings['quantization'], model_dir)
+
+    min_cosine = compare_encoders(load_onnx_model(settings), load_torch_model(settings), sentences)
+    validations = read_validations(model_dir)
+    validations[onnx_file_name(settings)] = {'min_cosine': min_cosine, 'validated_at': time.time()}
+    with open(os.path.join(model_dir, 'validation.json'), 'w', encoding='utf-8') as file:
+        json.dump(validations, file, indent=2)
+    return validations[onnx_file_name(settings)]
+
+
+def read_validations(model_dir: str) -> dict:
+    try:
+        with open(os.path.join(model_dir, 'validation.json'), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_model(settings: dict = None) -> SentenceTransformer:
+    settings = settings or model_settings()
+    if settings['backend'] not in ENCODER_BACKENDS:
+        raise ValueError(f"EMBEDDING_BACKEND inválido: {settings['backend']!r} (use um de {ENCODER_BACKENDS})")
+
+    model = None
+    if settings['backend'] == 'onnx':
+        validation = read_validations(onnx_model_dir(settings)).get(onnx_file_name(settings))
+        if validation is None:
+            validation = export_onnx_model(settings)
+        if validation['min_cosine'] >= settings['min_cosine']:
+            model = load_onnx_model(settings)
+        else:
+            # Vetores fora da tolerância não seriam comparáveis aos já gravados: fica o PyTorch
+            print(f"Encoder ONNX {onnx_file_name(settings)} abaixo do cosseno mínimo "
+                  f"({validation['min_cosine']:.4f} < {settings['min_cosine']}); usando PyTorch")
+    if model is None:
+        model = load_torch_model(settings)
+
+    if settings['max_seq_length'] > 0:
+        model.max_seq_length = settings['max_seq_length']
+    model.encode(WARMUP_SENTENCES)
+    return model
+
+
+def get_embedding_model() -> SentenceTransformer:
+    """Encoder único do processo; a primeira chamada carrega e aquece o modelo."""
+    global _model, _load_error
+    if _model is not None:
+        return _model
+    with _load_lock:
+        if _model is None:
+            started_at = time.perf_counter()
+            try:
+                _model = load_model()
+            except Exception as e:
+                _load_error = e
+                raise
+            _load_error = None
+            _ready.set()
+            print(f"Modelo de embedding carregado em {time.perf_counter() - started_at:.1f}s")
+    return _model
+
+
+def _warmup():
+    try:
+        get_embedding_model()
+    except Exception:
+        # O erro fica em _load_error e volta a ser lançado na próxima chamada síncrona
+        pass
+
+
+def start_warmup():
+    """Carrega o modelo em segundo plano assim que o processo sobe, sem bloquear a interface."""
+    global _warmup_thread
+    with _lock:
+        if _model is not None or (_warmup_thread is not None and _warmup_thread.is_alive()):
+            return
+        _warmup_thread = threading.Thread(target=_warmup, name='embedding-warmup', daemon=True)
+        _warmup_thread.start()
+
+
+def is_ready() -> bool:
+    return _ready.is_set()
+
+
+def wait_until_ready(timeout: float = None) -> bool:
+    return _ready.wait(timeout)
+
+
+def load_error():
+    return _load_error
+
+
+class EmbeddingBatcher:
+    """Agrupa as frases enviadas por várias sessões numa única passada do encoder.
+
+    A primeira frase que chega abre uma janela de `window` segundos; o que chegar
+    nesse intervalo (até `max_batch_size` frases) é codificado junto, e cada
+    chamador recebe o seu vetor pelo próprio Future.
+    """
+
+    def __init__(self, window: float, max_batch_size: int):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self.sentences = 0
+        self._pending = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='embedding-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self._pending.put((text, future))
+        return future
+
+    def _collect(self) -> list:
+        batch = [self._pending.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            futures = [future for _, future in batch if future.set_running_or_notify_cancel()]
+            texts = [text for text, future in batch if future in futures]
+            if not texts:
+                continue
+            try:
+                embeddings = model_encode(texts, batch_size=len(texts))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.sentences += len(texts)
+            for future, embedding in zip(futures, embeddings):
+                future.set_result(embedding)
+
+
+_batcher = None
+
+
+def get_batcher():
+    """Agrupador compartilhado pelo processo, ou None se a janela estiver desligada."""
+    global _batcher
+    if _batcher is None:
+        settings = model_settings()
+        if settings['batch_window_ms'] <= 0:
+            return None
+        with _lock:
+            if _batcher is None:
+                _batcher = EmbeddingBatcher(settings['batch_window_ms'] / 1000, settings['max_batch_size'])
+    return _batcher
+
+
+_query_cache = None
+
+
+def get_query_cache():
+    """Cache de embeddings de perguntas do processo, ou None se estiver desligado."""
+    global _query_cache
+    if _query_cache is None:
+        settings = model_settings()
+        if settings['cache_size'] <= 0:
+            return None
+        with _lock:
+            if _query_cache is None:
+                _query_cache = QueryEmbeddingCache(
+                    settings['cache_size'], settings['cache_path'] or None,
+                    settings['cache_disk_slots'], model_id(settings),
+                )
+    return _query_cache
+
+
+def model_encode(texts, **kwargs):
+    """Chamada direta ao encoder, limitada pelo controle de admissão para não disputar a CPU."""
+    model = get_embedding_model()
+    with get_admission_controller().encoder_slot():
+        return model.encode(texts, **kwargs)
+
+
+def encode(texts, batch_size: int = 32):
+    """Codifica uma frase ou uma lista de frases com o encoder compartilhado.
+
+    Frases avulsas (as perguntas dos usuários) consultam antes o cache de perguntas
+    e, se não estiverem lá, passam pelo agrupador, que junta as chamadas simultâneas;
+    listas já chegam em lote e vão direto ao modelo.
+    """
+    if not isinstance(texts, str):
+        return model_encode(texts, batch_size=batch_size)
+
+    cache = get_query_cache()
+    embedding = cache.get(texts) if cache is not None else None
+    if embedding is not None:
+        return embedding
+
+    batcher = get_batcher()
+    embedding = batcher.submit(texts).result() if batcher is not None else model_encode(texts)
+    return cache.put(texts, embedding) if cache is not None else embedding
+
+
+if __name__ == '__main__':
+    # Usado no deploy antes de subir o app: baixa os pesos para o cache local, exporta e
+    # valida o ONNX quando EMBEDDING_BACKEND=onnx e mede a carga
+    if model_settings()['backend'] == 'onnx':
+        print(f"Validação do encoder ONNX: {export_onnx_model()}")
+    get_embedding_model()
@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+from bson.binary import Binary, USER_DEFINED_SUBTYPE
+from pymongo import UpdateOne
+
+# Formatos de armazenamento das embeddings no MongoDB:
+#   'array'   -> array BSON de doubles (formato legado)
+#   'float32' -> vetor binário BSON (subtipo 9), compatível com o $vectorSearch do Atlas
+#   'float16' -> binário float16 compacto (subtipo definido pelo usuário)
+STORAGE_FORMATS = ('array', 'float32', 'float16')
+
+# Subtipo 9 = vetor BSON; o primeiro byte indica o dtype e o segundo o padding
+VECTOR_SUBTYPE = 9
+VECTOR_DTYPE_INT8 = 0x03
+VECTOR_DTYPE_FLOAT32 = 0x27
+
+
+def get_storage_format(storage: str = None) -> str:
+    """Valida o formato informado ou lê o configurado em EMBEDDING_STORAGE (padrão: float32)."""
+    storage = storage or os.getenv('EMBEDDING_STORAGE', 'float32')
+    if storage not in STORAGE_FORMATS:
+        raise ValueError(f"Formato de embedding desconhecido: {storage!r}. Opções: {', '.join(STORAGE_FORMATS)}")
+    return storage
+
+
+def encode_embedding(embedding, storage: str = None):
+    """Converte a embedding para o formato de armazenamento escolhido."""
+    storage = get_storage_format(storage)
+    vector = np.asarray(embedding, dtype=np.float32).ravel()
+    if storage == 'array':
+        return vector.tolist()
+    if storage == 'float16':
+        return Binary(vector.astype('<f2').tobytes(), USER_DEFINED_SUBTYPE)
+    return Binary(bytes([VECTOR_DTYPE_FLOAT32, 0]) + vector.astype('<f4').tobytes(), VECTOR_SUBTYPE)
+
+
+def decode_embedding(value) -> np.ndarray:
+    """Lê a embedding armazenada; formatos binários viram uma view sem cópia (np.frombuffer)."""
+    if isinstance(value, Binary) and value.subtype == VECTOR_SUBTYPE:
+        if value[0] == VECTOR_DTYPE_FLOAT32:
+            return np.frombuffer(value, dtype='<f4', offset=2)
+        if value[0] == VECTOR_DTYPE_INT8:
+            return np.frombuffer(value, dtype=np.int8, offset=2).astype(np.float32)
+        raise ValueError(f"dtype de vetor BSON não suportado: {value[0]:#x}")
+    if isinstance(value, Binary) and value.subtype == USER_DEFINED_SUBTYPE:
+        return np.frombuffer(value, dtype='<f2')
+    return np.asarray(value, dtype=np.float32)
+
+
+def stored_format(value):
+    """Formato em que uma embedding foi gravada ('array', 'float32', 'float16'), ou None."""
+    if isinstance(value, Binary) and value.subtype == VECTOR_SUBTYPE:
+        return 'float32' if value[0] == VECTOR_DTYPE_FLOAT32 else None
+    if isinstance(value, Binary) and value.subtype == USER_DEFINED_SUBTYPE:
+        return 'float16'
+    if isinstance(value, list):
+        return 'array'
+    return None
+
+
+def migrate_embeddings(collection, storage: str = None, batch_size: int = 500) -> int:
+    """Reescreve as embeddings armazenadas como array BSON no formato binário configurado.
+
+    Chamada pela ingestão sobre a coleção de staging, que herda as embeddings da geração
+    ativa: as gerações já publicadas nunca são alteradas no lugar.
+    """
+    storage = get_storage_format(storage)
+    if storage == 'array':
+        return 0
+
+    migrated = 0
+    operations = []
+    for doc in collection.find({'embedding': {'$type': 'array'}}, {'_id': 1, 'embedding': 1}):
+        operations.append(UpdateOne({'_id': doc['_id']}, {'$set': {'embedding': encode_embedding(doc['embedding'], storage)}}))
+        if len(operations) >= batch_size:
+            migrated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        migrated += collection.bulk_write(operations, ordered=False).modified_count
+
+    return migrated
+
@@ -1,48 +1,350 @@
-from sentence_transformers import SentenceTransformer
+import hashlib
+import json
+import multiprocessing
 import os
-from pymongo import MongoClient
-from pymongo.server_api import ServerApi
-from sentence_transformers import SentenceTransformer
-from pymongo import MongoClient
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import InsertOne, DeleteMany
 from dotenv import load_dotenv
+from chunking import CHUNK_OVERLAP, CHUNK_SIZE, chunk_text
+from embedding_model import get_embedding_model
+from embedding_storage import encode_embedding, migrate_embeddings
+from knowledge_base import (copy_collection, drop_old_generations, generation_name, get_mongo_client,
+                            next_generation, read_pointer, resolve_collection, swap_generation,
+                            validate_generation)
+from lexical_index import build_lexical_index
+from member_routing import build_member_routes
+from vector_index import VectorIndex
 
 load_dotenv()
 MONGO_URI = os.getenv('MONGO_URI')
-mongo_client = MongoClient(MONGO_URI)
+ENCODE_BATCH_SIZE = int(os.getenv('ENCODE_BATCH_SIZE', '32'))
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '500'))
+READER_THREADS = int(os.getenv('READER_THREADS', '4'))
+# Tamanho das filas entre os estágios: limita a memória independentemente do tamanho do corpus
+QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', str(ENCODE_BATCH_SIZE * 4)))
+CHECKPOINT_PATH = os.getenv('INGEST_CHECKPOINT', './data/ingest_checkpoint.jsonl')
+COLLECTION_NAME = "members_informations"
 
 def connection_mongodb():
-    mongo_client = MongoClient(MONGO_URI)
+    mongo_client = get_mongo_client(MONGO_URI)
     db = mongo_client["pingpoli"]
-    collection = db["members_informations"]
-    
-    return collection
 
-def insert_document_in_mongodb(file_name: str, text: str, embedding, collection):
-    document = {
+    return db
+
+def build_chunks(file_name: str, text: str, content_hash: str) -> list:
+    """Divide o arquivo em trechos sobrepostos, guardando os offsets e o arquivo de origem."""
+    spans = chunk_text(text)
+    return [
+        {
             'file_name': file_name,
-            'text': text,
-            'embedding': embedding
+            'chunk_index': chunk_index,
+            'chunk_count': len(spans),
+            'start': start,
+            'end': end,
+            'text': text[start:end],
+            'content_hash': content_hash
         }
+        for chunk_index, (start, end) in enumerate(spans)
+    ]
+
+def build_document(chunk: dict, embedding) -> dict:
+    return {**chunk, 'embedding': encode_embedding(embedding)}
+
+def write_documents_in_mongodb(documents: list, collection):
+    """Grava os trechos em lotes; a nova versão de um arquivo entra antes de a antiga ser removida."""
+    operations = []
+    for document in documents:
+        operations.append(InsertOne(document))
+        # Os trechos de um arquivo chegam juntos; a versão antiga sai depois do último deles
+        if document['chunk_index'] == document['chunk_count'] - 1:
+            operations.append(DeleteMany({'file_name': document['file_name'], 'content_hash': {'$ne': document['content_hash']}}))
+
+    for start in range(0, len(operations), WRITE_BATCH_SIZE * 2):
+        collection.bulk_write(operations[start:start + WRITE_BATCH_SIZE * 2], ordered=True)
+
+def content_hash_of(text: str) -> str:
+    """Hash do conteúdo e dos parâmetros de divisão: mudar CHUNK_SIZE/CHUNK_OVERLAP redivide tudo."""
+    chunking = f"chunk_size={CHUNK_SIZE};chunk_overlap={CHUNK_OVERLAP}\n"
+    return hashlib.sha256((chunking + text).encode('utf-8')).hexdigest()
+
+def load_embedding_model():
+    # Mesmo dispositivo, threads e max_seq_length configurados para os apps
+    return get_embedding_model()
+
+def transform_sentences_to_embeddings(model, sentences: list):
+    return model.encode(sentences, batch_size=ENCODE_BATCH_SIZE)
+
+# ==============================================================================
+# CHECKPOINT (retomada de execuções interrompidas)
+# ==============================================================================
+
+def load_checkpoint():
+    """Cabeçalho e arquivos já gravados (nome -> hash) por uma execução interrompida, ou (None, None)."""
+    if not os.path.exists(CHECKPOINT_PATH):
+        return None, None
+    header, written = {}, {}
+    with open(CHECKPOINT_PATH, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Última linha cortada pela interrupção
+                continue
+            if 'file_name' in entry:
+                written[entry['file_name']] = entry['content_hash']
+            else:
+                header = entry
+    return header, written
+
+def append_checkpoint(documents: list):
+    with open(CHECKPOINT_PATH, "a", encoding="utf-8") as f:
+        for document in documents:
+            if document['chunk_index'] != document['chunk_count'] - 1:
+                continue
+            f.write(json.dumps({'file_name': document['file_name'], 'content_hash': document['content_hash']}) + "\n")
+
+def start_checkpoint(header: dict):
+    os.makedirs(os.path.dirname(CHECKPOINT_PATH) or '.', exist_ok=True)
+    if not os.path.exists(CHECKPOINT_PATH):
+        with open(CHECKPOINT_PATH, "w", encoding="utf-8") as f:
+            f.write(json.dumps({**header, 'started_at': time.time()}) + "\n")
+
+def clear_checkpoint():
+    if os.path.exists(CHECKPOINT_PATH):
+        os.remove(CHECKPOINT_PATH)
+
+def load_stored_hashes(collection, written: dict) -> dict:
+    """Hash do conteúdo já indexado de cada arquivo no staging (None se precisa ser recodificado).
+
+    Os trechos de um arquivo podem ter sido gravados em mais de um bulk_write; se a
+    execução caiu entre eles, o staging tem parte da versão nova junto com a antiga.
+    Um arquivo só conta como gravado se estiver no checkpoint ou se tiver uma única
+    versão com todos os trechos; senão os trechos dele são apagados e ele é recodificado.
+    """
+    versions = {}
+    for doc in collection.find({}, {'_id': 0, 'file_name': 1, 'content_hash': 1, 'chunk_count': 1}):
+        version = versions.setdefault(doc['file_name'], {}).setdefault(doc.get('content_hash'), [0, doc.get('chunk_count')])
+        version[0] += 1
+
+    stored_hashes = {}
+    for file, hashes in versions.items():
+        if file in written:
+            stored_hashes[file] = written[file]
+        elif len(hashes) == 1 and all(count == chunk_count for count, chunk_count in hashes.values()):
+            stored_hashes[file] = next(iter(hashes))
+        else:
+            print(f"{file}: gravação incompleta no staging, recodificando")
+            collection.delete_many({'file_name': file})
+            stored_hashes[file] = None
+    return stored_hashes
+
+# ==============================================================================
+# ESTÁGIOS DO PIPELINE: leitura (threads) -> codificação (processo) -> escrita
+# ==============================================================================
+
+def discover_files(directory: str):
+    """Percorre o diretório sob demanda, sem listar todo o corpus em memória."""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                yield entry.name, entry.path
+
+def read_stage(directory: str, stored_hashes: dict, to_encode, seen_files: set, stats: dict, errors: list):
+    """Lê os arquivos com um pool de threads e envia ao encoder apenas os novos ou alterados."""
+    slots = threading.BoundedSemaphore(QUEUE_SIZE)
+    stats_lock = threading.Lock()
+
+    def read_file(file: str, full_path: str):
+        try:
+            with open(full_path, "r", encoding="utf-8") as f:
+                member_text = f.read()
+            content_hash = content_hash_of(member_text)
+            if stored_hashes.get(file) == content_hash:
+                with stats_lock:
+                    stats['skipped'] += 1
+            else:
+                for chunk in build_chunks(file, member_text, content_hash):
+                    to_encode.put(chunk)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=READER_THREADS) as executor:
+        for file, full_path in discover_files(directory):
+            if errors:
+                break
+            seen_files.add(file)
+            slots.acquire()
+            executor.submit(read_file, file, full_path)
+
+    to_encode.put(None)
+
+def encoder_worker(to_encode, encoded, batch_size: int):
+    """Processo dedicado ao encoder: só codifica, sem esperar por disco ou MongoDB."""
+    model = None
+    finished = False
+    while not finished:
+        batch = [to_encode.get()]
+        while len(batch) < batch_size:
+            try:
+                batch.append(to_encode.get_nowait())
+            except queue.Empty:
+                break
+        if None in batch:
+            batch.remove(None)
+            finished = True
+        if batch:
+            # O modelo é carregado uma única vez, e só se houver algo para codificar
+            if model is None:
+                model = load_embedding_model()
+            embeddings = transform_sentences_to_embeddings(model, [chunk['text'] for chunk in batch])
+            for chunk, embedding in zip(batch, embeddings):
+                encoded.put((chunk, embedding))
+    encoded.put(None)
+
+def write_stage(collection, encoded, encoder, stored_hashes: dict, stats: dict):
+    """Grava em lote o que sai do encoder e registra o progresso no checkpoint.
+
+    Um arquivo só vai para a escrita quando todos os seus trechos estão codificados.
+    """
+    to_write = []
+    incomplete = {}
+
+    def flush():
+        write_documents_in_mongodb(to_write, collection)
+        append_checkpoint(to_write)
+        to_write.clear()
+
+    while True:
+        try:
+            item = encoded.get(timeout=1)
+        except queue.Empty:
+            if not encoder.is_alive():
+                raise RuntimeError("O processo do encoder terminou inesperadamente")
+            # Nada chegando: grava o que já está pronto em vez de segurar em memória
+            if to_write:
+                flush()
+            continue
+        if item is None:
+            break
+
+        chunk, embedding = item
+        file_chunks = incomplete.setdefault(chunk['file_name'], [])
+        file_chunks.append(build_document(chunk, embedding))
+        if len(file_chunks) < chunk['chunk_count']:
+            continue
+
+        del incomplete[chunk['file_name']]
+        to_write.extend(sorted(file_chunks, key=lambda document: document['chunk_index']))
+        stats['updated' if chunk['file_name'] in stored_hashes else 'inserted'] += 1
+        stats['chunks'] += len(file_chunks)
+        if len(to_write) >= WRITE_BATCH_SIZE:
+            flush()
+
+    if to_write:
+        flush()
+
+def main():
+    directory = "./data/raw"
+    db = connection_mongodb()
+
+    # Blue/green: a nova geração é montada numa coleção de staging enquanto a ativa
+    # continua atendendo; uma execução interrompida retoma o mesmo staging
+    checkpoint, resumed_files = load_checkpoint()
+    active_generation = read_pointer(db, COLLECTION_NAME).get('generation', 0)
+    if checkpoint and checkpoint.get('staging') and checkpoint.get('generation', 0) <= active_generation:
+        # A troca já aconteceu (a execução caiu depois dela): o "staging" do checkpoint é a geração ativa
+        print(f"Checkpoint da geração {checkpoint.get('generation')} ignorado: a geração ativa é {active_generation}")
+        clear_checkpoint()
+        checkpoint, resumed_files = None, None
+    if checkpoint and checkpoint.get('staging'):
+        print(f"Retomando execução interrompida ({len(resumed_files)} arquivos já gravados)")
+        generation, staging_name = checkpoint['generation'], checkpoint['staging']
+    else:
+        resumed_files = None
+        generation = next_generation(db, COLLECTION_NAME)
+        staging_name = generation_name(COLLECTION_NAME, generation)
+        db.drop_collection(staging_name)
+        copy_collection(resolve_collection(db, COLLECTION_NAME), staging_name)
+    start_checkpoint({'generation': generation, 'staging': staging_name})
+
+    collection = db[staging_name]
+    collection.create_index([('file_name', 1), ('chunk_index', 1)])
+
+    # Hash do conteúdo já indexado de cada arquivo: só arquivos novos ou alterados são recodificados
+    stored_hashes = load_stored_hashes(collection, resumed_files or {})
+
+    seen_files = set()
+    reader_errors = []
+    stats = {'inserted': 0, 'updated': 0, 'skipped': 0, 'chunks': 0}
+    started_at = time.perf_counter()
+
+    context = multiprocessing.get_context('spawn')
+    to_encode = context.Queue(maxsize=QUEUE_SIZE)
+    encoded = context.Queue(maxsize=QUEUE_SIZE)
+    encoder = context.Process(target=encoder_worker, args=(to_encode, encoded, ENCODE_BATCH_SIZE), daemon=True)
+    encoder.start()
+
+    reader = threading.Thread(
+        target=read_stage, args=(directory, stored_hashes, to_encode, seen_files, stats, reader_errors), daemon=True
+    )
+    reader.start()
+    write_stage(collection, encoded, encoder, stored_hashes, stats)
+    reader.join()
+    encoder.join()
+
+    # Com a leitura incompleta não dá para saber quais arquivos foram removidos
+    if reader_errors:
+        raise reader_errors[0]
+
+    elapsed = time.perf_counter() - started_at
+    processed = stats['inserted'] + stats['updated']
+    if processed:
+        print(f"{processed} arquivos ({stats['chunks']} trechos) codificados e gravados em {elapsed:.1f}s "
+              f"({stats['chunks'] / elapsed:.1f} trechos/s)")
+
+    removed_files = [file for file in stored_hashes if file not in seen_files]
+    if removed_files:
+        collection.delete_many({'file_name': {'$in': removed_files}})
+
+    print(f"{stats['inserted']} novos, {stats['updated']} alterados, {len(removed_files)} removidos, {stats['skipped']} sem mudança")
+
+    # Trechos copiados da geração anterior podem estar no formato legado (array); com
+    # EMBEDDING_STORAGE binário eles são convertidos aqui, antes de montar os índices
+    migrated = migrate_embeddings(collection)
+    if migrated:
+        print(f"{migrated} embeddings convertidas para o formato configurado")
 
-    collection.insert_one(document)
+    # Sem mudanças, a geração ativa continua valendo e o staging é descartado
+    if not (processed or removed_files or resumed_files or migrated):
+        db.drop_collection(staging_name)
+        clear_checkpoint()
+        return
 
-def transform_sentence_to_embedding(sentence: str) -> list:
-    model = SentenceTransformer('PORTULAN/serafim-100m-portuguese-pt-sentence-encoder-ir')
-    embedding = model.encode(sentence)
-    
-    return embedding
+    # Constrói e persiste o índice vetorial, para que os apps apenas o carreguem do disco
+    vector_index = VectorIndex(collection)
+    vector_index.build()
+    vector_index.save()
 
-directory = "./data/raw"
-collection = connection_mongodb()
-result = collection.delete_many({})
+    # Índice invertido BM25 para a busca lexical (apelidos, nomes exatos)
+    build_lexical_index(collection)
 
-for file in os.listdir(directory):
-    full_path = os.path.join(directory, file)
+    # Tabela nome/apelido -> arquivo para o roteamento direto de perguntas sobre membros
+    build_member_routes(collection)
 
-    if os.path.isfile(full_path):
-        with open(full_path, "r", encoding="utf-8") as f:
+    problems = validate_generation(collection, seen_files)
+    if problems:
+        raise RuntimeError(f"Geração {staging_name} inválida, a ativa foi mantida: " + "; ".join(problems))
 
-            member_text = f.read()
-            embedding = transform_sentence_to_embedding(member_text).tolist()
+    swap_generation(db, COLLECTION_NAME, staging_name, generation)
+    # Depois da troca o staging é a geração ativa e não pode mais ser retomado
+    clear_checkpoint()
+    print(f"Geração {generation} ativa ({staging_name})")
+    drop_old_generations(db, COLLECTION_NAME)
 
-            insert_document_in_mongodb(file, member_text, embedding, collection)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
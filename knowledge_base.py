@@ -0,0 +1,149 @@
+import os
+import re
+import shutil
+import threading
+import time
+
+from pymongo import MongoClient
+
+from embedding_storage import decode_embedding
+from vector_index import forget_vector_index
+
+# Coleção com os ponteiros "nome lógico -> geração ativa" da base de conhecimento
+POINTERS_COLLECTION = 'kb_pointers'
+
+# Por quanto tempo (em segundos) o ponteiro lido é reaproveitado antes de consultar de novo
+POINTER_TTL = 5.0
+
+# Gerações mantidas após a troca: a ativa e a anterior (para rollback)
+KEEP_GENERATIONS = 2
+
+# Coleções auxiliares gravadas ao lado de cada geração
+SIDECAR_SUFFIXES = ('_bm25', '_aliases', '_suggestions')
+
+_clients = {}
+_pointers = {}
+_lock = threading.Lock()
+
+
+def get_mongo_client(uri: str) -> MongoClient:
+    """Um único MongoClient (e seu pool de conexões) por URI em todo o processo."""
+    with _lock:
+        client = _clients.get(uri)
+        if client is None:
+            client = _clients[uri] = MongoClient(uri)
+        return client
+
+
+def generation_name(logical_name: str, generation: int) -> str:
+    return f'{logical_name}_g{generation:04d}'
+
+
+def read_pointer(db, logical_name: str) -> dict:
+    return db[POINTERS_COLLECTION].find_one({'_id': logical_name}) or {}
+
+
+def _cached_pointer(db, logical_name: str) -> dict:
+    key = (db.name, logical_name)
+    with _lock:
+        cached = _pointers.get(key)
+    if cached and time.monotonic() - cached['checked_at'] < POINTER_TTL:
+        return cached
+
+    pointer = read_pointer(db, logical_name)
+    fresh = {
+        'collection': pointer.get('collection', logical_name),
+        'generation': pointer.get('generation', 0),
+        'checked_at': time.monotonic(),
+    }
+    with _lock:
+        _pointers[key] = fresh
+
+    # Nova geração ativa: o índice residente da anterior pode ser liberado
+    if cached and cached['collection'] != fresh['collection']:
+        forget_vector_index(f"{db.name}.{cached['collection']}")
+    return fresh
+
+
+def resolve_collection(db, logical_name: str):
+    """Coleção física da geração ativa; sem ponteiro, a própria coleção lógica."""
+    return db[_cached_pointer(db, logical_name)['collection']]
+
+
+def current_generation(db, logical_name: str) -> int:
+    """Versão da base de conhecimento, usada para invalidar caches após um reindex."""
+    return _cached_pointer(db, logical_name)['generation']
+
+
+def existing_generations(db, logical_name: str) -> list[int]:
+    pattern = re.compile(rf'^{re.escape(logical_name)}_g(\d+)$')
+    return sorted(int(match.group(1)) for name in db.list_collection_names() if (match := pattern.match(name)))
+
+
+def next_generation(db, logical_name: str) -> int:
+    return max([read_pointer(db, logical_name).get('generation', 0), *existing_generations(db, logical_name)]) + 1
+
+
+def copy_collection(source, target_name: str):
+    """Copia a geração ativa para a de staging no próprio servidor, sem reprocessar nada."""
+    if source.estimated_document_count():
+        source.aggregate([{'$match': {}}, {'$out': target_name}])
+
+
+def validate_generation(collection, expected_files: set) -> list[str]:
+    """Confere contagens e dimensões antes da troca; retorna a lista de problemas."""
+    problems = []
+    if expected_files and collection.count_documents({}) == 0:
+        problems.append('a coleção de staging está vazia')
+
+    files = {}
+    for group in collection.aggregate([
+        {'$group': {'_id': '$file_name', 'chunks': {'$sum': 1}, 'expected': {'$max': '$chunk_count'}}},
+    ]):
+        files[group['_id']] = group
+        if group['expected'] is not None and group['chunks'] != group['expected']:
+            problems.append(f"{group['_id']}: {group['chunks']} trechos de {group['expected']}")
+
+    missing = expected_files - set(files)
+    extra = set(files) - expected_files
+    if missing:
+        problems.append(f'{len(missing)} arquivos ausentes (ex.: {sorted(missing)[0]})')
+    if extra:
+        problems.append(f'{len(extra)} arquivos que não existem mais (ex.: {sorted(extra)[0]})')
+
+    dimensions = {}
+    for doc in collection.find({}, {'embedding': 1}):
+        dim = len(decode_embedding(doc['embedding'])) if doc.get('embedding') is not None else 0
+        dimensions[dim] = dimensions.get(dim, 0) + 1
+    if len(dimensions) > 1 or 0 in dimensions:
+        problems.append(f'dimensões de embedding inconsistentes: {dimensions}')
+
+    return problems
+
+
+def swap_generation(db, logical_name: str, physical_name: str, generation: int):
+    """Aponta o nome lógico para a nova geração numa única escrita atômica."""
+    db[POINTERS_COLLECTION].update_one(
+        {'_id': logical_name},
+        {'$set': {'collection': physical_name, 'generation': generation, 'swapped_at': time.time()}},
+        upsert=True,
+    )
+    with _lock:
+        _pointers.pop((db.name, logical_name), None)
+
+
+def drop_old_generations(db, logical_name: str, keep: int = KEEP_GENERATIONS, index_dir: str = None):
+    """Remove gerações antigas, suas coleções auxiliares e seus índices em disco."""
+    index_dir = index_dir or os.getenv('VECTOR_INDEX_DIR', './data/index')
+    active = read_pointer(db, logical_name).get('generation', 0)
+    for generation in existing_generations(db, logical_name):
+        # Mantém as `keep` gerações mais recentes e qualquer staging ainda em construção
+        if generation > active - keep:
+            continue
+        name = generation_name(logical_name, generation)
+        for suffix in ('', *SIDECAR_SUFFIXES):
+            db.drop_collection(name + suffix)
+        if os.path.isdir(index_dir):
+            for entry in os.listdir(index_dir):
+                if entry.startswith(f'{db.name}.{name}.'):
+                    shutil.rmtree(os.path.join(index_dir, entry), ignore_errors=True)
@@ -0,0 +1,130 @@
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+
+from pymongo import InsertOne
+
+from chunking import PASSAGE_FIELDS
+from vector_index import search_similar_documents, to_passage
+
+# Parâmetros clássicos do BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Documento da coleção auxiliar com as estatísticas globais ('$' não aparece em tokens)
+STATS_ID = '$stats'
+
+STOPWORDS = {
+    'a', 'ao', 'aos', 'as', 'com', 'como', 'da', 'das', 'de', 'do', 'dos', 'e', 'ela', 'ele',
+    'em', 'eu', 'fale', 'isso', 'mais', 'me', 'na', 'nas', 'no', 'nos', 'o', 'os', 'ou', 'para',
+    'por', 'qual', 'quais', 'quando', 'que', 'quem', 'se', 'sobre', 'sao', 'seu', 'sua', 'um',
+    'uma', 'voce',
+}
+
+
+def tokenize(text: str) -> list[str]:
+    """Tokens em minúsculas, sem acentos e sem stopwords."""
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return [token for token in re.findall(r'\w+', text) if len(token) > 1 and token not in STOPWORDS]
+
+
+def lexical_collection(collection):
+    """Coleção auxiliar, ao lado da coleção principal, que guarda o índice invertido."""
+    return collection.database[f'{collection.name}_bm25']
+
+
+def build_lexical_index(collection, batch_size: int = 1000) -> int:
+    """Monta o índice invertido BM25 sobre o campo `text` e o grava na coleção auxiliar."""
+    postings = {}
+    doc_count = 0
+    total_length = 0
+    for doc in collection.find({}, {'_id': 1, 'text': 1}):
+        tokens = tokenize(doc.get('text') or '')
+        doc_count += 1
+        total_length += len(tokens)
+        for term, tf in Counter(tokens).items():
+            postings.setdefault(term, []).append([doc['_id'], tf, len(tokens)])
+
+    target = lexical_collection(collection)
+    target.delete_many({})
+    operations = [InsertOne({'_id': STATS_ID, 'doc_count': doc_count, 'avg_doc_len': total_length / max(doc_count, 1)})]
+    for term, term_postings in postings.items():
+        operations.append(InsertOne({'_id': term, 'df': len(term_postings), 'postings': term_postings}))
+        if len(operations) >= batch_size:
+            target.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        target.bulk_write(operations, ordered=False)
+
+    return len(postings)
+
+
+def lexical_search(collection, query_text: str, k: int = 5) -> tuple[list[dict], bool]:
+    """Busca BM25 usando só as listas invertidas dos termos da pergunta.
+
+    Retorna os k melhores ({'_id', 'score'}) e se a pergunta é um acerto de nome
+    inequívoco: todos os termos da pergunta estão no índice e existem apenas no
+    mesmo documento. Um termo fora do índice ("comida", "2019") indica que a
+    pergunta é sobre outra coisa, e aí a busca densa não pode ser pulada.
+    """
+    terms = set(tokenize(query_text))
+    if not terms:
+        return [], False
+
+    entries = {doc['_id']: doc for doc in lexical_collection(collection).find({'_id': {'$in': [*terms, STATS_ID]}})}
+    stats = entries.pop(STATS_ID, None)
+    if not stats or not entries:
+        return [], False
+
+    scores = {}
+    for entry in entries.values():
+        idf = math.log(1 + (stats['doc_count'] - entry['df'] + 0.5) / (entry['df'] + 0.5))
+        for doc_id, tf, doc_len in entry['postings']:
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len / stats['avg_doc_len'])
+            scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    is_name_hit = (
+        len(ranked) == 1
+        and len(entries) == len(terms)
+        and all(entry['df'] == 1 for entry in entries.values())
+    )
+
+    return [{'_id': doc_id, 'score': score} for doc_id, score in ranked[:k]], is_name_hit
+
+
+def hybrid_search(collection, query_text: str, encode, k: int = 5, lexical_weight: float = None,
+                  lexical: tuple = None) -> list[dict]:
+    """Combina BM25 e similaridade densa: peso * lexical + (1 - peso) * denso.
+
+    `encode` só é chamado quando necessário: se a pergunta é um acerto de nome
+    inequívoco, a resposta sai apenas do índice lexical, sem passar pelo encoder;
+    com `encode=None` a busca é só lexical. O peso vem de LEXICAL_WEIGHT (padrão 0.3);
+    com peso 0 a busca é só densa. `lexical` recebe o resultado de `lexical_search`
+    já calculado (com k * 2 resultados), para quem o buscou em paralelo ao encoder.
+    """
+    if lexical_weight is None:
+        lexical_weight = float(os.getenv('LEXICAL_WEIGHT', '0.3'))
+    if lexical_weight <= 0 and encode is not None:
+        return search_similar_documents(collection, encode(query_text), k)
+
+    lexical_hits, is_name_hit = lexical if lexical is not None else lexical_search(collection, query_text, k * 2)
+    max_lexical = lexical_hits[0]['score'] if lexical_hits else 1.0
+    fused = {hit['_id']: lexical_weight * hit['score'] / max_lexical for hit in lexical_hits}
+    docs = {}
+
+    if not is_name_hit and encode is not None:
+        for doc in search_similar_documents(collection, encode(query_text), k * 2):
+            docs[doc['_id']] = doc
+            fused[doc['_id']] = fused.get(doc['_id'], 0.0) + (1 - lexical_weight) * max(doc['similarity'], 0.0)
+
+    missing = [key for key in fused if key not in docs]
+    if missing:
+        for doc in collection.find({'_id': {'$in': missing}}, PASSAGE_FIELDS):
+            docs[doc['_id']] = to_passage(doc, 0.0)
+
+    ranked = sorted((key for key in fused if key in docs), key=lambda key: fused[key], reverse=True)
+    return [{**docs[key], 'similarity': fused[key]} for key in ranked[:k]]
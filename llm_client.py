@@ -0,0 +1,260 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+import httpx
+from groq import APIConnectionError, APIStatusError, Groq
+
+from admission import Overloaded, get_admission_controller
+from context_builder import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Threads compartilhadas pelas sessões do processo para as chamadas (e cópias) à API
+LLM_WORKERS = int(os.getenv('LLM_WORKERS', '16'))
+
+# Latências guardadas por modelo para calcular o atraso do hedge
+LATENCY_WINDOW = 200
+# Mínimo de amostras para usar o percentil no lugar do atraso padrão
+LATENCY_MIN_SAMPLES = 20
+
+
+def llm_settings() -> dict:
+    return {
+        'connect_timeout': float(os.getenv('LLM_CONNECT_TIMEOUT', '5')),
+        # Espera máxima por cada leitura da resposta (no streaming, entre dois pedaços)
+        'read_timeout': float(os.getenv('LLM_READ_TIMEOUT', '30')),
+        'max_retries': int(os.getenv('LLM_MAX_RETRIES', '3')),
+        'backoff_base': float(os.getenv('LLM_BACKOFF_BASE', '0.5')),
+        'backoff_max': float(os.getenv('LLM_BACKOFF_MAX', '8')),
+        # Hedge: uma segunda requisição igual depois do percentil de latência, a primeira a responder vale
+        'hedging': os.getenv('LLM_HEDGING', '0').lower() in ('1', 'true', 'yes'),
+        'hedge_quantile': float(os.getenv('LLM_HEDGE_QUANTILE', '0.95')),
+        'hedge_delay': float(os.getenv('LLM_HEDGE_DELAY', '3')),
+        'hedge_min_delay': float(os.getenv('LLM_HEDGE_MIN_DELAY', '0.5')),
+        # Modelo mais rápido usado quando o principal esgota as tentativas; vazio desliga
+        'fallback_model': os.getenv('LLM_FALLBACK_MODEL', 'llama-3.1-8b-instant'),
+        # Por quanto tempo (em segundos) um modelo que falhou fica em segundo plano
+        'degraded_cooldown': float(os.getenv('LLM_DEGRADED_COOLDOWN', '60')),
+    }
+
+
+def is_retryable(error: Exception) -> bool:
+    """Limite de taxa (429), erro do servidor (5xx), timeout ou falha de conexão."""
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, APIConnectionError)
+
+
+def retry_after(error: Exception):
+    """Segundos pedidos pela API no cabeçalho Retry-After, se houver."""
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers['retry-after'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class LatencyTracker:
+    """Latências recentes de um modelo (até o primeiro pedaço, no streaming)."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float):
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < LATENCY_MIN_SAMPLES:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+class PrefetchedStream:
+    """Stream da Groq cujo primeiro pedaço já foi lido (para saber quem respondeu primeiro)."""
+
+    def __init__(self, completion, first_chunk):
+        self.completion = completion
+        self.first_chunk = first_chunk
+
+    def __iter__(self):
+        if self.first_chunk is not None:
+            yield self.first_chunk
+        yield from self.completion
+
+    def close(self):
+        self.completion.close()
+
+
+def iter_completion_text(completion):
+    """Texto de uma resposta da Groq em streaming; fechar o gerador encerra a conexão."""
+    try:
+        for chunk in completion:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        completion.close()
+
+
+class ResilientLLMClient:
+    """Chamadas de chat à Groq com timeouts, novas tentativas, hedge e modelo reserva.
+
+    Erros 429/5xx, timeouts e falhas de conexão são repetidos com espera exponencial
+    com jitter (respeitando Retry-After). Com hedge ligado, se a resposta (o primeiro
+    pedaço, no streaming) demora mais que o percentil `hedge_quantile` das latências
+    recentes do modelo, uma segunda requisição igual é disparada e vale a primeira a
+    responder. Quando o modelo pedido esgota as tentativas, a pergunta vai para o
+    modelo reserva e o principal fica em segundo plano por `degraded_cooldown`
+    segundos. Depois que o texto começa a chegar não há nova tentativa. Toda
+    requisição enviada consome a cota da Groq no controle de admissão.
+    """
+
+    def __init__(self, client, settings: dict = None):
+        self.client = client
+        self.settings = settings or llm_settings()
+        self._latencies = {}
+        self._degraded_until = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix='llm')
+
+    def latency(self, model: str) -> LatencyTracker:
+        with self._lock:
+            tracker = self._latencies.get(model)
+            if tracker is None:
+                tracker = self._latencies[model] = LatencyTracker()
+            return tracker
+
+    def hedge_delay(self, model: str) -> float:
+        delay = self.latency(model).quantile(self.settings['hedge_quantile'])
+        if delay is None:
+            return self.settings['hedge_delay']
+        return max(delay, self.settings['hedge_min_delay'])
+
+    def is_degraded(self, model: str) -> bool:
+        with self._lock:
+            return time.monotonic() < self._degraded_until.get(model, 0.0)
+
+    def mark_degraded(self, model: str):
+        with self._lock:
+            self._degraded_until[model] = time.monotonic() + self.settings['degraded_cooldown']
+
+    def models_for(self, model: str) -> list[str]:
+        """Ordem de tentativa: o reserva vai na frente enquanto o modelo pedido estiver degradado."""
+        fallback = self.settings['fallback_model']
+        if not fallback or fallback == model:
+            return [model]
+        return [fallback, model] if self.is_degraded(model) else [model, fallback]
+
+    def _request(self, model: str, messages: list, temperature: float, stream: bool):
+        started = time.monotonic()
+        completion = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=stream,
+        )
+        if stream:
+            try:
+                completion = PrefetchedStream(completion, next(iter(completion), None))
+            except Exception:
+                completion.close()
+                raise
+        self.latency(model).record(time.monotonic() - started)
+        return completion
+
+    def _discard(self, future, stream: bool):
+        """Cancela a requisição perdedora do hedge ou fecha o stream dela quando terminar."""
+        if future.cancel() or not stream:
+            return
+        future.add_done_callback(lambda done: done.exception() is None and done.result().close())
+
+    def _race(self, model: str, messages: list, temperature: float, stream: bool):
+        # Cada requisição (inclusive novas tentativas e hedges) consome a cota da conta na Groq
+        admission = get_admission_controller()
+        tokens = sum(count_tokens(message['content']) for message in messages)
+        if not admission.take_llm_quota(tokens):
+            raise Overloaded("cota de requisições da Groq esgotada")
+        futures = [self._executor.submit(self._request, model, messages, temperature, stream)]
+        if self.settings['hedging']:
+            done, _ = wait(futures, timeout=self.hedge_delay(model))
+            # O hedge só sai se houver cota sobrando agora
+            if not done and admission.take_llm_quota(tokens, wait=False):
+                logger.info("LLM: %s demorou mais que o esperado, disparando requisição de hedge", model)
+                futures.append(self._executor.submit(self._request, model, messages, temperature, stream))
+
+        error = None
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            for other in futures:
+                if other is not future:
+                    self._discard(other, stream)
+            return result
+        raise error
+
+    def _with_retries(self, model: str, messages: list, temperature: float, stream: bool):
+        for attempt in range(self.settings['max_retries'] + 1):
+            try:
+                return self._race(model, messages, temperature, stream)
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.settings['max_retries']:
+                    raise
+                # Espera exponencial com jitter total, ou o que a API pedir
+                delay = random.uniform(0, min(self.settings['backoff_max'], self.settings['backoff_base'] * 2 ** attempt))
+                delay = max(delay, min(retry_after(e) or 0.0, self.settings['backoff_max']))
+                logger.warning("LLM: %s falhou (%s), nova tentativa em %.1fs", model, e, delay)
+                time.sleep(delay)
+
+    def complete(self, messages: list, model: str, temperature: float = 0.8, stream: bool = False):
+        """Texto da resposta; com `stream=True`, um gerador com os pedaços à medida que chegam."""
+        models = self.models_for(model)
+        for position, candidate in enumerate(models):
+            try:
+                completion = self._with_retries(candidate, messages, temperature, stream)
+            except Exception as e:
+                if position == len(models) - 1 or not is_retryable(e):
+                    raise
+                if candidate == model:
+                    self.mark_degraded(model)
+                logger.warning("LLM: %s indisponível (%s), usando %s", candidate, e, models[position + 1])
+                continue
+            if stream:
+                return iter_completion_text(completion)
+            return completion.choices[0].message.content
+
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_llm_client(api_key: str, base_url: str = None) -> ResilientLLMClient:
+    """Um único cliente por chave e endereço da API em todo o processo.
+
+    `base_url` (ou GROQ_BASE_URL) aponta para outro servidor compatível, como um
+    servidor local falso nos testes. As novas tentativas ficam com o
+    ResilientLLMClient, então as do SDK são desligadas.
+    """
+    base_url = base_url or os.getenv('GROQ_BASE_URL') or None
+    with _lock:
+        client = _clients.get((api_key, base_url))
+        if client is None:
+            settings = llm_settings()
+            groq_client = Groq(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=httpx.Timeout(settings['read_timeout'], connect=settings['connect_timeout']),
+                max_retries=0,
+            )
+            client = _clients[(api_key, base_url)] = ResilientLLMClient(groq_client, settings)
+        return client
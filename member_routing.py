@@ -0,0 +1,153 @@
+import os
+import re
+import threading
+import time
+import unicodedata
+
+import yaml
+from pymongo import InsertOne
+
+from chunking import PASSAGE_FIELDS, merge_chunks
+
+# Intervalo mínimo (em segundos) entre duas leituras da tabela de apelidos
+REFRESH_INTERVAL = 30.0
+
+# Campos dos documentos de membros que trazem nomes e apelidos
+NAME_FIELD_PATTERN = re.compile(r'^\s*(?:nome|apelidos?)\s*:\s*(.+)$', re.IGNORECASE | re.MULTILINE)
+
+# Perguntas que citam um único membro: "Fale sobre X", "Quem é X", "Quero saber sobre X"
+MEMBER_QUERY_PATTERN = re.compile(
+    r'^(?:(?:me )?(?:fale|fala|conte|conta) (?:sobre|d[oae]s?)|quem (?:e|eh)|quero saber (?:sobre|d[oae]s?))'
+    r'(?: (?:o|a))? (?P<member>.+)$'
+)
+
+# Maior quantidade de palavras do trecho "X" analisada na busca por apelidos
+MAX_MEMBER_WORDS = 4
+
+
+def normalize_name(text: str) -> str:
+    """Minúsculas, sem acentos e com palavras separadas por um único espaço."""
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(re.findall(r'\w+', text))
+
+
+def alias_collection(collection):
+    """Coleção auxiliar, ao lado da coleção principal, com a tabela apelido -> arquivo."""
+    return collection.database[f'{collection.name}_aliases']
+
+
+def load_member_aliases(prompts_path: str = 'prompts.yaml') -> dict:
+    """Tabela de apelidos definida em `member_aliases` no arquivo de prompts."""
+    try:
+        with open(prompts_path, 'r', encoding='utf-8') as file:
+            return yaml.safe_load(file).get('member_aliases') or {}
+    except (OSError, yaml.YAMLError, AttributeError):
+        return {}
+
+
+def build_member_routes(collection, aliases: dict = None) -> dict:
+    """Monta e grava o índice nome/apelido -> arquivo do membro.
+
+    As chaves vêm do nome de cada arquivo em `data/raw`, dos campos "Nome:" e
+    "Apelido:" do seu conteúdo e da tabela `member_aliases` do prompts.yaml.
+    Nomes que apontam para mais de um arquivo são descartados por serem ambíguos.
+    """
+    aliases = load_member_aliases() if aliases is None else aliases
+    candidates = {}
+
+    for doc in collection.find({}, {'file_name': 1, 'text': 1}):
+        file_name = doc.get('file_name')
+        if not file_name:
+            continue
+        names = [os.path.splitext(file_name)[0].replace('_', ' ').replace('-', ' ')]
+        for match in NAME_FIELD_PATTERN.finditer(doc.get('text') or ''):
+            names.extend(re.split(r'[,;/]| e ', match.group(1)))
+        for name in names:
+            key = normalize_name(name)
+            if key:
+                candidates.setdefault(key, set()).add(file_name)
+
+    routes = {key: next(iter(files)) for key, files in candidates.items() if len(files) == 1}
+
+    for canonical, member_aliases in aliases.items():
+        file_name = routes.get(normalize_name(canonical))
+        if file_name is None:
+            continue
+        for alias in member_aliases:
+            routes[normalize_name(alias)] = file_name
+
+    target = alias_collection(collection)
+    target.delete_many({})
+    if routes:
+        target.bulk_write([InsertOne({'_id': key, 'file_name': file_name}) for key, file_name in routes.items()])
+    collection.create_index([('file_name', 1), ('chunk_index', 1)])
+
+    return routes
+
+
+class MemberRouter:
+    """Tabela apelido -> arquivo mantida em memória para o roteamento direto."""
+
+    def __init__(self, collection, refresh_interval: float = REFRESH_INTERVAL):
+        self.collection = collection
+        self.refresh_interval = refresh_interval
+        self._routes = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def routes(self) -> dict:
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_interval:
+                self._routes = {doc['_id']: doc['file_name'] for doc in alias_collection(self.collection).find()}
+                self._loaded_at = time.monotonic()
+            return self._routes
+
+    def resolve(self, user_input: str):
+        """Nome do arquivo do membro citado na pergunta, ou None se não for inequívoco."""
+        match = MEMBER_QUERY_PATTERN.match(normalize_name(user_input))
+        if not match:
+            return None
+
+        routes = self.routes()
+        member = match.group('member')
+        if member in routes:
+            return routes[member]
+
+        # "Grandioso Shigueru", "o berijela da equipe": procura apelidos dentro do trecho
+        words = member.split()
+        if len(words) > MAX_MEMBER_WORDS:
+            return None
+        files = {
+            routes[' '.join(words[start:end])]
+            for start in range(len(words))
+            for end in range(start + 1, len(words) + 1)
+            if ' '.join(words[start:end]) in routes
+        }
+        return files.pop() if len(files) == 1 else None
+
+    def find_member_document(self, user_input: str):
+        """Documento do membro citado, buscado pela chave, sem embedding nem varredura.
+
+        Os trechos do arquivo são reunidos de volta no texto completo do membro.
+        """
+        file_name = self.resolve(user_input)
+        if file_name is None:
+            return None
+        chunks = [chunk for chunk in self.collection.find({'file_name': file_name}, PASSAGE_FIELDS) if 'text' in chunk]
+        if not chunks:
+            return None
+        return {'_id': chunks[0]['_id'], 'text': merge_chunks(chunks), 'file_name': file_name, 'similarity': 1.0}
+
+
+_routers = {}
+_routers_lock = threading.Lock()
+
+
+def find_member_document(collection, user_input: str):
+    """Consulta o roteador compartilhado pelo processo para a coleção informada."""
+    with _routers_lock:
+        router = _routers.get(collection.full_name)
+        if router is None:
+            router = _routers[collection.full_name] = MemberRouter(collection)
+    return router.find_member_document(user_input)
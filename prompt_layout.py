@@ -0,0 +1,112 @@
+import argparse
+import json
+import os
+
+from context_builder import build_context, context_settings, count_tokens
+from embedding_model import encode
+from lexical_index import hybrid_search
+from prompt_registry import get_prompt_registry
+
+# Instruções de uso do CONTEXTO, fixas: ficam no system, depois das diretrizes do prompts.yaml
+CONTEXT_INSTRUCTIONS = (
+    "Você é um assistente de IA especialista. Use o CONTEXTO fornecido na mensagem do usuário para responder à PERGUNTA.\n"
+    "Responda de forma clara e concisa, baseando-se exclusivamente nas informações do CONTEXTO.\n"
+    "Se a resposta não estiver no CONTEXTO, diga educadamente: \"Não encontrei informações sobre isso nos meus documentos.\""
+)
+
+
+def build_chat_messages(prompt_messages: list[dict], instructions: str, context: str) -> list[dict]:
+    """Mensagens enviadas ao modelo, com tudo o que é fixo no início.
+
+    O system (diretrizes do prompts.yaml seguidas de `instructions`) é idêntico byte a
+    byte entre perguntas; o CONTEXTO e a PERGUNTA vão na mensagem do usuário, no fim.
+    Assim o provedor reaproveita o prefixo já processado (cache de prompt) em vez de
+    reprocessar as diretrizes a cada pergunta.
+    """
+    system = [message['content'] for message in prompt_messages if message['role'] == 'system']
+    question = "\n\n".join(message['content'] for message in prompt_messages if message['role'] == 'user')
+    return [
+        {'role': 'system', 'content': "\n\n".join(system + [instructions])},
+        {'role': 'user', 'content': f"CONTEXTO:\n{context}\n\nPERGUNTA:\n{question}"},
+    ]
+
+
+def count_message_tokens(messages: list[dict]) -> int:
+    return sum(count_tokens(message['content']) for message in messages)
+
+
+def request_bytes(messages: list[dict], model: str) -> bytes:
+    """Corpo da requisição como a API o recebe; é sobre ele que o prefixo estável é medido."""
+    return json.dumps({'model': model, 'messages': messages}, ensure_ascii=False).encode('utf-8')
+
+
+def measure_prefix_stability(requests: list[bytes]) -> dict:
+    """Quantos bytes do início de cada requisição se repetem nas requisições anteriores.
+
+    `stable_with_previous` compara cada requisição com a anterior (o que um cache de
+    prefixo aproveitaria numa sequência de perguntas) e `shared_by_all` é o prefixo
+    comum a todas.
+    """
+    if not requests:
+        return {'requests': 0}
+    with_previous = [len(os.path.commonprefix([previous, current])) for previous, current in zip(requests, requests[1:])]
+    shared = os.path.commonprefix(requests)
+    mean_bytes = sum(len(request) for request in requests) / len(requests)
+    return {
+        'requests': len(requests),
+        'mean_bytes': mean_bytes,
+        'shared_by_all': len(shared),
+        'shared_by_all_tokens': count_tokens(shared.decode('utf-8', errors='ignore')),
+        'stable_with_previous': sum(with_previous) / len(with_previous) if with_previous else float(len(shared)),
+        'stable_fraction': (
+            sum(stable / len(request) for stable, request in zip(with_previous, requests[1:])) / len(with_previous)
+            if with_previous else 1.0
+        ),
+    }
+
+
+def replay_query_log(path: str, model: str, collection=None) -> dict:
+    """Monta o prompt de cada pergunta do log (uma por linha) e mede o prefixo estável.
+
+    Com `collection` o CONTEXTO vem da busca na base, como no app; sem ela fica vazio.
+    """
+    registry = get_prompt_registry()
+    requests = []
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            question = line.strip()
+            if not question:
+                continue
+            documents = []
+            if collection is not None:
+                documents = hybrid_search(collection, question, encode, context_settings()['max_passages'])
+            context, _ = build_context(documents)
+            prompt_messages = registry.render_messages("system_user_prompt", user_input=question)
+            messages = build_chat_messages(prompt_messages, CONTEXT_INSTRUCTIONS, context)
+            requests.append(request_bytes(messages, model))
+    return measure_prefix_stability(requests)
+
+
+if __name__ == '__main__':
+    # Ex.: python prompt_layout.py perguntas.txt --with-context
+    parser = argparse.ArgumentParser(description="Mede o prefixo estável dos prompts sobre um log de perguntas")
+    parser.add_argument('query_log', help="arquivo com uma pergunta por linha")
+    parser.add_argument('--model', default="meta-llama/llama-4-maverick-17b-128e-instruct")
+    parser.add_argument('--with-context', action='store_true', help="busca o CONTEXTO na base (usa MONGO_URI)")
+    args = parser.parse_args()
+
+    collection = None
+    if args.with_context:
+        from dotenv import load_dotenv
+        from knowledge_base import get_mongo_client, resolve_collection
+        load_dotenv()
+        collection = resolve_collection(get_mongo_client(os.getenv('MONGO_URI'))["pingpoli"], "members_informations")
+
+    report = replay_query_log(args.query_log, args.model, collection)
+    if report['requests'] == 0:
+        print("Nenhuma pergunta no log.")
+    else:
+        print(f"Requisições: {report['requests']} (média de {report['mean_bytes']:.0f} bytes)")
+        print(f"Prefixo comum a todas: {report['shared_by_all']} bytes (~{report['shared_by_all_tokens']} tokens)")
+        print(f"Prefixo estável em relação à anterior: {report['stable_with_previous']:.0f} bytes "
+              f"({report['stable_fraction']:.1%} da requisição)")
@@ -0,0 +1,187 @@
+import hashlib
+import logging
+import os
+import re
+import string
+import textwrap
+import threading
+import time
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# Intervalo mínimo (em segundos) entre duas verificações do arquivo de prompts
+CHECK_INTERVAL = 1.0
+
+# Marcadores do formato de chat do Llama usados nos templates do prompts.yaml
+_ROLE_HEADER = re.compile(r'<\|start_header_id\|>(\w+)<\|end_header_id\|>')
+_SPECIAL_TOKENS = re.compile(r'<\|(?:begin_of_text|end_of_text|eot_id)\|>')
+
+
+def split_roles(text: str):
+    """Texto de cada papel (system, user, ...) de um template no formato de chat do Llama.
+
+    Os marcadores especiais são removidos, já que a API monta o formato do modelo a
+    partir das mensagens. None se o texto não tiver marcadores de papel.
+    """
+    parts = _ROLE_HEADER.split(text)
+    if len(parts) == 1:
+        return None
+    roles = {}
+    for role, body in zip(parts[1::2], parts[2::2]):
+        body = textwrap.dedent(_SPECIAL_TOKENS.sub('', body)).strip()
+        if body:
+            roles[role] = body
+    return roles
+
+
+class PromptTemplate:
+    """Template do prompts.yaml já dividido em trechos fixos e campos a preencher.
+
+    `render` produz o mesmo texto que `str.format`, sem reinterpretar o template a
+    cada pergunta.
+    """
+
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.text = text
+        self.segments = []
+        self.fields = set()
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            if literal:
+                self.segments.append((literal, None, None, None))
+            if field is not None:
+                if not field.isidentifier():
+                    raise ValueError(f"campo {{{field}}} inválido no prompt {name!r}")
+                if spec and ('{' in spec):
+                    raise ValueError(f"especificação aninhada não suportada no prompt {name!r}")
+                self.segments.append((None, field, spec, conversion))
+                self.fields.add(field)
+
+        # Mensagens de chat do template; sem marcadores de papel, o texto todo é do usuário
+        roles = split_roles(text)
+        self.roles = {role: PromptTemplate(f'{name}.{role}', body) for role, body in roles.items()} if roles else {'user': self}
+
+    @property
+    def static_prefix(self) -> str:
+        """Texto fixo antes do primeiro campo, igual em todas as perguntas."""
+        prefix = []
+        for literal, field, _, _ in self.segments:
+            if field is not None:
+                break
+            prefix.append(literal)
+        return ''.join(prefix)
+
+    def render(self, **values) -> str:
+        parts = []
+        for literal, field, spec, conversion in self.segments:
+            if field is None:
+                parts.append(literal)
+                continue
+            value = values[field]
+            if conversion == 'r':
+                value = repr(value)
+            elif conversion == 'a':
+                value = ascii(value)
+            elif conversion == 's':
+                value = str(value)
+            parts.append(format(value, spec or ''))
+        return ''.join(parts)
+
+    def render_messages(self, **values) -> list[dict]:
+        """Mensagens de chat ({'role', 'content'}) na ordem do template, sem a do assistente."""
+        return [
+            {'role': role, 'content': template.render(**values)}
+            for role, template in self.roles.items()
+            if role != 'assistant'
+        ]
+
+
+class PromptRegistry:
+    """Prompts do arquivo YAML interpretados uma vez e recarregados quando o arquivo muda.
+
+    A cada acesso (no máximo uma vez por `check_interval`) o mtime e o tamanho do
+    arquivo são conferidos; se mudaram, o conteúdo é relido e só é reinterpretado se
+    o hash também mudou. Uma edição malformada não substitui a última versão boa:
+    o erro fica em `last_error` e os prompts anteriores continuam valendo.
+    """
+
+    def __init__(self, path: str = 'prompts.yaml', check_interval: float = CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.version = None
+        self.last_error = None
+        self.data = {}
+        self.templates = {}
+        self._stat = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _reload_if_changed(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            try:
+                stat = os.stat(self.path)
+            except OSError as e:
+                self.last_error = e
+                return
+            if self._stat == (stat.st_mtime_ns, stat.st_size):
+                return
+
+            try:
+                with open(self.path, 'rb') as file:
+                    content = file.read()
+                version = hashlib.sha256(content).hexdigest()[:12]
+                if version != self.version:
+                    data = yaml.safe_load(content)
+                    if not isinstance(data, dict):
+                        raise ValueError('o arquivo de prompts deve ser um mapeamento nome -> prompt')
+                    templates = {name: PromptTemplate(name, text) for name, text in data.items() if isinstance(text, str)}
+                    self.data, self.templates, self.version = data, templates, version
+                    logger.info("Prompts carregados de %s (versão %s)", self.path, version)
+                self._stat = (stat.st_mtime_ns, stat.st_size)
+                self.last_error = None
+            except (OSError, ValueError, yaml.YAMLError) as e:
+                # Mantém a última versão boa; a próxima mudança do arquivo é tentada de novo
+                self._stat = (stat.st_mtime_ns, stat.st_size)
+                self.last_error = e
+                logger.warning("Erro ao recarregar %s, mantendo a versão %s: %s", self.path, self.version, e)
+
+    def get(self, name: str) -> PromptTemplate:
+        """Template do prompt; KeyError se o nome não existir na versão carregada."""
+        self._reload_if_changed()
+        return self.templates[name]
+
+    def render(self, name: str, **values) -> str:
+        return self.get(name).render(**values)
+
+    def render_messages(self, name: str, **values) -> list[dict]:
+        return self.get(name).render_messages(**values)
+
+    def section(self, name: str, default=None):
+        """Outras seções do arquivo (listas, tabelas), na versão carregada."""
+        self._reload_if_changed()
+        return self.data.get(name, default)
+
+    def current_version(self):
+        self._reload_if_changed()
+        return self.version
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_prompt_registry(path: str = 'prompts.yaml') -> PromptRegistry:
+    """Registro de prompts compartilhado pelas sessões do processo."""
+    with _registries_lock:
+        registry = _registries.get(path)
+        if registry is None:
+            registry = _registries[path] = PromptRegistry(path)
+        return registry
@@ -0,0 +1,182 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from answer_cache import get_answer_cache
+from chunking import expand_with_neighbours
+from context_builder import context_settings
+from embedding_model import encode
+from knowledge_base import current_generation
+from lexical_index import hybrid_search, lexical_search
+from member_routing import find_member_document
+from prompt_registry import get_prompt_registry
+
+logger = logging.getLogger(__name__)
+
+# Threads compartilhadas pelas sessões do processo para as etapas de cada pergunta
+PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', '16'))
+
+# Intervalo (em segundos) entre duas conferências do cancelamento enquanto uma etapa é esperada
+CANCEL_POLL_INTERVAL = 0.1
+
+_executor = None
+_lock = threading.Lock()
+
+# Pergunta em preparação de cada sessão; uma pergunta nova da mesma sessão cancela a anterior
+_sessions = {}
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix='pipeline')
+    return _executor
+
+
+def stage_timeouts() -> dict:
+    """Prazo de cada etapa, em segundos, contado a partir do início da pergunta."""
+    return {
+        'embedding': float(os.getenv('PIPELINE_EMBEDDING_TIMEOUT', '5')),
+        'retrieval': float(os.getenv('PIPELINE_RETRIEVAL_TIMEOUT', '8')),
+        'prompt': float(os.getenv('PIPELINE_PROMPT_TIMEOUT', '2')),
+    }
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+class RequestPipeline:
+    """Prepara o contexto de uma pergunta com as etapas independentes rodando em paralelo.
+
+    Leitura do prompt, roteamento por membro e listas do BM25 começam juntos; o
+    embedding da pergunta só é calculado quando a busca densa e o cache de respostas
+    vão usá-lo (nem pergunta roteada para um membro nem acerto de nome passam pelo
+    encoder). Uma etapa que estoura o prazo é abandonada e a resposta segue com o que
+    houver (busca só lexical, prompt padrão). `cancel()` descarta o que ainda não
+    começou e interrompe as esperas de `prepare()` com RequestCancelled; com
+    `session_id`, uma pergunta nova da mesma sessão cancela a que ainda estava sendo
+    preparada (usuário mandou outra pergunta ou a página foi recarregada).
+    """
+
+    def __init__(self, collection, user_input: str, k: int = None, timeouts: dict = None, session_id: str = None):
+        self.collection = collection
+        self.user_input = user_input
+        # Candidatos da busca; o k efetivo é decidido na montagem do contexto
+        self.k = k or context_settings()['max_passages']
+        self.timeouts = timeouts or stage_timeouts()
+        self.session_id = session_id
+        self.started_at = time.monotonic()
+        self._cancelled = threading.Event()
+        self._futures = []
+        if session_id is not None:
+            with _lock:
+                previous = _sessions.get(session_id)
+                _sessions[session_id] = self
+            if previous is not None:
+                previous.cancel()
+
+    def submit(self, fn, *args):
+        self.check()
+        future = get_executor().submit(self._run, fn, *args)
+        self._futures.append(future)
+        return future
+
+    def _run(self, fn, *args):
+        self.check()
+        return fn(*args)
+
+    def result(self, future, stage: str, default=None):
+        """Resultado da etapa dentro do seu prazo; `default` se estourar ou falhar."""
+        deadline = self.started_at + self.timeouts[stage]
+        try:
+            # Espera em fatias para que um cancelamento não fique preso atrás da etapa
+            while True:
+                self.check()
+                remaining = deadline - time.monotonic()
+                try:
+                    return future.result(timeout=max(min(remaining, CANCEL_POLL_INTERVAL), 0))
+                except TimeoutError:
+                    if remaining <= CANCEL_POLL_INTERVAL:
+                        raise
+        except TimeoutError:
+            future.cancel()
+            return default
+        except RequestCancelled:
+            raise
+        except Exception as e:
+            logger.warning("Etapa %s falhou: %s", stage, e)
+            return default
+        finally:
+            self.check()
+
+    def check(self):
+        if self._cancelled.is_set():
+            raise RequestCancelled()
+
+    def cancel(self):
+        self._cancelled.set()
+        for future in self._futures:
+            future.cancel()
+        if self.session_id is not None:
+            with _lock:
+                if _sessions.get(self.session_id) is self:
+                    del _sessions[self.session_id]
+
+    def _search(self, embedding, lexical):
+        encoder = (lambda _: embedding) if embedding is not None else None
+        passages = hybrid_search(self.collection, self.user_input, encoder, self.k, lexical=lexical)
+        return expand_with_neighbours(self.collection, passages)
+
+    def prepare(self, load_prompt) -> dict:
+        """Contexto da pergunta: {'cached_answer', 'documents', 'system_user_prompt', ...}.
+
+        Com `cached_answer` preenchido a pergunta já foi respondida: `documents` são os
+        trechos usados naquela resposta e `system_user_prompt` vem vazio. `answer_cache`
+        é None quando a resposta não deve ir para o cache (pergunta roteada para um membro
+        ou acerto de nome, que não calculam o embedding).
+        `system_user_prompt` é None se `load_prompt` não terminar no prazo.
+        """
+        prompt = self.submit(load_prompt, self.user_input)
+        member = self.submit(find_member_document, self.collection, self.user_input)
+        lexical = self.submit(lexical_search, self.collection, self.user_input, self.k * 2)
+
+        # Respostas guardadas valem para uma geração da base e uma versão dos prompts
+        cache_version = (
+            current_generation(self.collection.database, 'members_informations'),
+            get_prompt_registry().current_version(),
+        )
+        prepared = {'cache_version': cache_version, 'query_embedding': None, 'answer_cache': None}
+
+        # "Fale sobre <membro>" com outro nome passa fácil do limite de similaridade: perguntas
+        # roteadas não consultam nem alimentam o cache, para não responder sobre o membro errado
+        member_document = self.result(member, 'retrieval')
+        if member_document:
+            documents = [member_document]
+        else:
+            lexical_hits = self.result(lexical, 'retrieval', ([], False))
+            if lexical_hits[1]:
+                # Acerto de nome: a resposta sai só do índice lexical, sem o encoder
+                documents = self.result(self.submit(self._search, None, lexical_hits), 'retrieval', [])
+            else:
+                query_embedding = self.result(self.submit(encode, self.user_input), 'embedding')
+                answer_cache = get_answer_cache()
+                prepared.update(query_embedding=query_embedding, answer_cache=answer_cache)
+                if answer_cache is not None and query_embedding is not None:
+                    cached = answer_cache.lookup(query_embedding, cache_version)
+                    if cached:
+                        self.cancel()
+                        return {**prepared, 'cached_answer': cached['answer'], 'documents': cached['documents'], 'system_user_prompt': None}
+                documents = self.result(self.submit(self._search, query_embedding, lexical_hits), 'retrieval', [])
+
+        return {
+            **prepared,
+            'cached_answer': None,
+            'documents': documents,
+            'system_user_prompt': self.result(prompt, 'prompt'),
+        }
+
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+
+from pymongo import UpdateOne
+
+from embedding_cache import normalize_query
+from knowledge_base import current_generation
+from prompt_registry import get_prompt_registry
+
+logger = logging.getLogger(__name__)
+
+# Por quanto tempo (em segundos) as respostas lidas do MongoDB são reaproveitadas em memória
+ANSWERS_TTL = 30.0
+
+# Intervalo mínimo (em segundos) entre duas tentativas de recalcular as sugestões da mesma versão
+REFRESH_RETRY_INTERVAL = 300.0
+
+_answers = {}
+_refresh_started = {}
+_lock = threading.Lock()
+
+
+def load_suggestions(default: list) -> list[dict]:
+    """Perguntas dos botões de sugestão: `suggested_questions` do prompts.yaml ou a lista do app.
+
+    Cada item tem `label` (texto do botão) e `question` (pergunta enviada).
+    """
+    return get_prompt_registry().section('suggested_questions') or default
+
+
+def answers_version(collection) -> dict:
+    """Versão das respostas pré-calculadas: geração da base e versão dos prompts."""
+    return {
+        'generation': current_generation(collection.database, 'members_informations'),
+        'prompt_version': get_prompt_registry().current_version(),
+    }
+
+
+def suggestion_collection(collection):
+    """Coleção auxiliar, ao lado da geração, com as respostas pré-calculadas das sugestões."""
+    return collection.database[f'{collection.name}_suggestions']
+
+
+def stored_answers(collection, version: dict) -> dict:
+    """Respostas pré-calculadas da versão informada, por pergunta normalizada."""
+    key = collection.full_name
+    with _lock:
+        cached = _answers.get(key)
+    if cached and cached['version'] == version and time.monotonic() - cached['loaded_at'] < ANSWERS_TTL:
+        return cached['answers']
+
+    answers = {doc['_id']: doc for doc in suggestion_collection(collection).find(version)}
+    with _lock:
+        _answers[key] = {'version': version, 'answers': answers, 'loaded_at': time.monotonic()}
+    return answers
+
+
+def find_prewarmed_answer(collection, question: str):
+    """Resposta pré-calculada ({'answer', 'contexts', ...}) se a pergunta for de um botão de sugestão."""
+    return stored_answers(collection, answers_version(collection)).get(normalize_query(question))
+
+
+def refresh_suggestions(collection, version: dict, questions: list[str], answer_question) -> int:
+    """Calcula e grava as respostas das perguntas que ainda não têm resposta nesta versão.
+
+    `answer_question(pergunta)` devolve (resposta, textos do contexto) e deve lançar
+    exceção em caso de erro, para que uma falha da API não fique gravada como resposta.
+    """
+    existing = stored_answers(collection, version)
+    operations = []
+    for question in questions:
+        key = normalize_query(question)
+        if key in existing:
+            continue
+        try:
+            answer, contexts = answer_question(question)
+        except Exception as e:
+            logger.warning("Não foi possível pré-calcular a sugestão %r: %s", question, e)
+            continue
+        operations.append(UpdateOne(
+            {'_id': key},
+            {'$set': {
+                'question': question,
+                'answer': answer,
+                'contexts': contexts,
+                **version,
+                'generated_at': time.time(),
+            }},
+            upsert=True,
+        ))
+    if operations:
+        suggestion_collection(collection).bulk_write(operations, ordered=False)
+        with _lock:
+            _answers.pop(collection.full_name, None)
+    return len(operations)
+
+
+def start_suggestion_refresh(collection, questions: list[str], answer_question):
+    """Recalcula em segundo plano as respostas das sugestões quando a base ou os prompts mudam.
+
+    Chamado a cada execução do app; se as respostas da versão atual já existirem ou
+    uma atualização tiver começado há pouco (em andamento ou com falhas), não faz nada.
+    """
+    version = answers_version(collection)
+    key = (collection.full_name, version['generation'], version['prompt_version'])
+    existing = stored_answers(collection, version)
+    if all(normalize_query(question) in existing for question in questions):
+        return
+    with _lock:
+        started_at = _refresh_started.get(key)
+        if started_at is not None and time.monotonic() - started_at < REFRESH_RETRY_INTERVAL:
+            return
+        _refresh_started[key] = time.monotonic()
+
+    threading.Thread(
+        target=refresh_suggestions, args=(collection, version, questions, answer_question),
+        name='suggestion-refresh', daemon=True,
+    ).start()
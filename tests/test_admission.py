@@ -0,0 +1,146 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import AdmissionController, FairScheduler, Overloaded, TokenBucket, admission_settings  # noqa: E402
+
+
+def release_in_order(tickets: list) -> list[str]:
+    """Libera a pergunta admitida até a fila esvaziar; devolve as sessões na ordem de entrada."""
+    order = []
+    while True:
+        running = [ticket for ticket in tickets if ticket.granted and not ticket.done]
+        if not running:
+            return order
+        order.append(running[0].session_id)
+        running[0].release()
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_starts_full_and_reports_missing_time(self):
+        bucket = TokenBucket(60, capacity=2)
+        self.assertEqual(bucket.try_acquire(), 0.0)
+        self.assertEqual(bucket.try_acquire(), 0.0)
+        # 60 por minuto = uma ficha por segundo
+        self.assertAlmostEqual(bucket.try_acquire(), 1.0, delta=0.05)
+
+    def test_acquire_gives_up_without_waiting_when_refill_is_too_slow(self):
+        bucket = TokenBucket(60, capacity=1)
+        bucket.try_acquire()
+        started = time.monotonic()
+        self.assertFalse(bucket.acquire(1, timeout=0.1))
+        self.assertLess(time.monotonic() - started, 0.05)
+
+    def test_acquire_waits_for_refill(self):
+        bucket = TokenBucket(600, capacity=1)
+        bucket.try_acquire()
+        started = time.monotonic()
+        self.assertTrue(bucket.acquire(1, timeout=1.0))
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+
+    def test_cost_above_capacity_is_capped(self):
+        bucket = TokenBucket(60, capacity=5)
+        self.assertEqual(bucket.try_acquire(50), 0.0)
+
+
+class FairSchedulerTest(unittest.TestCase):
+
+    def test_sessions_take_turns(self):
+        scheduler = FairScheduler(max_concurrency=1, max_queue=10)
+        tickets = [scheduler.enqueue(session) for session in ('A', 'A', 'A', 'B', 'C')]
+        # A entra direto; as que esperam saem em rodadas: uma de cada sessão por vez
+        self.assertEqual(release_in_order(tickets), ['A', 'A', 'B', 'C', 'A'])
+
+    def test_late_session_is_not_stuck_behind_a_busy_one(self):
+        scheduler = FairScheduler(max_concurrency=1, max_queue=10)
+        tickets = [scheduler.enqueue('A') for _ in range(4)]
+        # B chega depois de uma fila inteira de A e entra já na próxima rodada
+        tickets.append(scheduler.enqueue('B'))
+        self.assertEqual(release_in_order(tickets), ['A', 'A', 'B', 'A', 'A'])
+
+    def test_positions(self):
+        scheduler = FairScheduler(max_concurrency=1, max_queue=10)
+        first, second, third, other = (scheduler.enqueue(session) for session in ('A', 'A', 'A', 'B'))
+        self.assertEqual([first.position, second.position, third.position, other.position], [0, 1, 3, 2])
+        other.release()
+        self.assertEqual([second.position, third.position], [1, 2])
+
+    def test_full_queue_is_rejected(self):
+        scheduler = FairScheduler(max_concurrency=1, max_queue=1)
+        scheduler.enqueue('A')
+        scheduler.enqueue('B')
+        with self.assertRaises(Overloaded):
+            scheduler.enqueue('C')
+
+    def test_release_of_waiting_ticket_leaves_the_queue(self):
+        scheduler = FairScheduler(max_concurrency=1, max_queue=10)
+        running, waiting = scheduler.enqueue('A'), scheduler.enqueue('B')
+        waiting.release()
+        self.assertEqual(scheduler.queued(), 0)
+        running.release()
+        self.assertEqual(scheduler.active, 0)
+
+
+class AdmissionControllerTest(unittest.TestCase):
+
+    def controller(self, **settings) -> AdmissionController:
+        return AdmissionController({
+            **admission_settings(),
+            'requests_per_minute': 0,
+            'tokens_per_minute': 0,
+            'max_concurrent_requests': 2,
+            'max_queue': 10,
+            'max_wait': 5.0,
+            **settings,
+        })
+
+    def test_limits_concurrency_and_reports_positions(self):
+        controller = self.controller()
+        lock = threading.Lock()
+        running, peak, positions = [0], [0], {}
+
+        def ask(session: str):
+            with controller.admit(session, lambda position: positions.setdefault(session, []).append(position)):
+                with lock:
+                    running[0] += 1
+                    peak[0] = max(peak[0], running[0])
+                time.sleep(0.3)
+                with lock:
+                    running[0] -= 1
+
+        threads = [threading.Thread(target=ask, args=(f"s{i}",)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(peak[0], 2)
+        # Quem esperou viu a posição na fila e, por fim, 0 ao ser admitido
+        self.assertTrue(positions)
+        for seen in positions.values():
+            self.assertGreater(seen[0], 0)
+            self.assertEqual(seen[-1], 0)
+
+    def test_wait_limit_rejects_and_leaves_the_queue(self):
+        controller = self.controller(max_concurrent_requests=1, max_wait=0.6)
+        controller.requests.enqueue('ocupada')
+        with self.assertRaises(Overloaded):
+            with controller.admit('atrasada'):
+                pass
+        self.assertEqual(controller.requests.queued(), 0)
+
+    def test_llm_quota(self):
+        controller = self.controller(requests_per_minute=2, quota_wait=0.1)
+        self.assertTrue(controller.take_llm_quota())
+        self.assertTrue(controller.take_llm_quota())
+        self.assertFalse(controller.take_llm_quota())
+        self.assertFalse(controller.take_llm_quota(wait=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import embedding_model
+except ImportError:  # sentence-transformers não instalado
+    embedding_model = None
+
+
+class FakeEncoder:
+    """Substitui `model_encode`: guarda os lotes recebidos e devolve um vetor por frase."""
+
+    def __init__(self, delay: float = 0.0, error: Exception = None):
+        self.delay = delay
+        self.error = error
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def __call__(self, texts, **kwargs):
+        with self._lock:
+            self.batches.append(list(texts))
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return np.array([[float(len(text)), 1.0] for text in texts], dtype=np.float32)
+
+
+@unittest.skipIf(embedding_model is None, "sentence-transformers não instalado")
+class EmbeddingBatcherTest(unittest.TestCase):
+
+    def batcher(self, encoder: FakeEncoder, window: float = 0.05, max_batch_size: int = 32):
+        patcher = mock.patch('embedding_model.model_encode', encoder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return embedding_model.EmbeddingBatcher(window, max_batch_size)
+
+    def test_groups_concurrent_sentences_and_routes_results(self):
+        encoder = FakeEncoder()
+        batcher = self.batcher(encoder, window=0.1)
+        texts = ["a", "bb", "ccc", "dddd"]
+        futures = [batcher.submit(text) for text in texts]
+        results = [future.result(timeout=2) for future in futures]
+
+        self.assertEqual(encoder.batches, [texts])
+        self.assertEqual([result[0] for result in results], [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual((batcher.batches, batcher.sentences), (1, 4))
+
+    def test_flushes_a_lone_sentence_when_the_window_ends(self):
+        encoder = FakeEncoder()
+        batcher = self.batcher(encoder, window=0.05)
+        started = time.monotonic()
+        self.assertEqual(batcher.submit("sozinha").result(timeout=2)[0], 7.0)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(encoder.batches, [["sozinha"]])
+
+    def test_splits_at_max_batch_size(self):
+        encoder = FakeEncoder()
+        batcher = self.batcher(encoder, window=0.2, max_batch_size=2)
+        futures = [batcher.submit(text) for text in ("a", "b", "c")]
+        for future in futures:
+            future.result(timeout=2)
+        self.assertEqual([len(batch) for batch in encoder.batches], [2, 1])
+
+    def test_skips_cancelled_sentences(self):
+        # Um lote lento segura o agrupador enquanto as próximas frases esperam na fila
+        encoder = FakeEncoder(delay=0.2)
+        batcher = self.batcher(encoder, window=0.01)
+        batcher.submit("primeira")
+        time.sleep(0.05)
+        cancelled, kept = batcher.submit("cancelada"), batcher.submit("mantida")
+        self.assertTrue(cancelled.cancel())
+        kept.result(timeout=2)
+        self.assertEqual(encoder.batches, [["primeira"], ["mantida"]])
+
+    def test_encoder_error_reaches_every_caller_and_batcher_keeps_running(self):
+        encoder = FakeEncoder(error=RuntimeError("encoder caiu"))
+        batcher = self.batcher(encoder, window=0.05)
+        futures = [batcher.submit(text) for text in ("a", "b")]
+        for future in futures:
+            with self.assertRaisesRegex(RuntimeError, "encoder caiu"):
+                future.result(timeout=2)
+
+        encoder.error = None
+        self.assertEqual(batcher.submit("ok").result(timeout=2)[0], 2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import httpx
+from groq import BadRequestError, Groq
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import AdmissionController, admission_settings  # noqa: E402
+from llm_client import ResilientLLMClient, llm_settings  # noqa: E402
+
+MESSAGES = [{'role': 'user', 'content': 'oi'}]
+
+
+class FakeGroqHandler(BaseHTTPRequestHandler):
+    """Servidor falso compatível com a API de chat da Groq.
+
+    `server.behaviour[modelo]` recebe quantas chamadas o modelo já teve e devolve um
+    status HTTP de erro, ('sleep', segundos) para demorar antes de responder, ou None
+    para responder normalmente (em SSE quando a requisição pede stream).
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['content-length'])))
+        model = body['model']
+        with self.server.lock:
+            attempt = self.server.calls.count(model)
+            self.server.calls.append(model)
+        action = self.server.behaviour.get(model, lambda attempt: None)(attempt)
+        if isinstance(action, int):
+            self.send_json(action, {'error': {'message': f"erro {action}"}}, {'retry-after': '0'})
+            return
+        if action is not None:
+            time.sleep(action[1])
+        if body.get('stream'):
+            self.send_stream(model, ['Olá', ', ', model])
+            return
+        self.send_json(200, {
+            'id': 'chatcmpl-1', 'object': 'chat.completion', 'created': 0, 'model': model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': f"resposta de {model}"}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2},
+        })
+
+    def send_json(self, status: int, payload: dict, headers: dict = None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, model: str, pieces: list[str]):
+        self.send_response(200)
+        self.send_header('content-type', 'text/event-stream')
+        self.end_headers()
+        for piece in pieces:
+            chunk = {
+                'id': 'chatcmpl-1', 'object': 'chat.completion.chunk', 'created': 0, 'model': model,
+                'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+class ResilientLLMClientTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeGroqHandler)
+        cls.server.lock = threading.Lock()
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.calls = []
+        self.server.behaviour = {}
+        settings = {
+            **llm_settings(),
+            'read_timeout': 5.0,
+            'backoff_base': 0.01,
+            'backoff_max': 0.05,
+            'hedging': False,
+            'hedge_delay': 0.3,
+            'fallback_model': 'reserva',
+        }
+        groq_client = Groq(
+            api_key='teste',
+            base_url=f"http://127.0.0.1:{self.server.server_address[1]}",
+            timeout=httpx.Timeout(settings['read_timeout'], connect=1.0),
+            max_retries=0,
+        )
+        self.client = ResilientLLMClient(groq_client, settings)
+        # Sem limite de cota, para os testes não dependerem do relógio
+        admission = AdmissionController({**admission_settings(), 'requests_per_minute': 0, 'tokens_per_minute': 0})
+        patcher = mock.patch('llm_client.get_admission_controller', return_value=admission)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retries_rate_limit(self):
+        self.server.behaviour['principal'] = lambda attempt: 429 if attempt < 2 else None
+        self.assertEqual(self.client.complete(MESSAGES, 'principal'), "resposta de principal")
+        self.assertEqual(self.server.calls, ['principal'] * 3)
+
+    def test_streams_after_retry(self):
+        self.server.behaviour['principal'] = lambda attempt: 429 if attempt == 0 else None
+        self.assertEqual(''.join(self.client.complete(MESSAGES, 'principal', stream=True)), "Olá, principal")
+        self.assertEqual(self.server.calls, ['principal'] * 2)
+
+    def test_falls_back_and_degrades_model(self):
+        self.server.behaviour['principal'] = lambda attempt: 503
+        self.assertEqual(self.client.complete(MESSAGES, 'principal'), "resposta de reserva")
+        retries = self.client.settings['max_retries']
+        self.assertEqual(self.server.calls, ['principal'] * (retries + 1) + ['reserva'])
+        self.assertTrue(self.client.is_degraded('principal'))
+
+        # Enquanto degradado, o reserva vai na frente sem passar pelo principal
+        self.server.calls.clear()
+        self.assertEqual(self.client.complete(MESSAGES, 'principal'), "resposta de reserva")
+        self.assertEqual(self.server.calls, ['reserva'])
+
+    def test_hedges_slow_stream(self):
+        self.client.settings['hedging'] = True
+        self.server.behaviour['principal'] = lambda attempt: ('sleep', 3.0) if attempt == 0 else None
+        started = time.monotonic()
+        self.assertEqual(''.join(self.client.complete(MESSAGES, 'principal', stream=True)), "Olá, principal")
+        self.assertLess(time.monotonic() - started, 2.0)
+        self.assertEqual(self.server.calls, ['principal'] * 2)
+
+    def test_does_not_retry_client_error(self):
+        self.server.behaviour['principal'] = lambda attempt: 400
+        with self.assertRaises(BadRequestError):
+            self.client.complete(MESSAGES, 'principal')
+        self.assertEqual(self.server.calls, ['principal'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vector_index  # noqa: E402
+from embedding_storage import encode_embedding  # noqa: E402
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+@unittest.skipIf(mongomock is None, "mongomock não instalado")
+class ServerRetrievalFallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        index_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(index_dir.cleanup)
+        patcher = mock.patch.dict(os.environ, {'VECTOR_INDEX_DIR': index_dir.name, 'VECTOR_INDEX_BACKEND': 'exact'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop('ATLAS_VECTOR_INDEX', None)
+
+        self.collection = mongomock.MongoClient()[f'teste_{id(self)}']['members_informations']
+        self.vectors = np.eye(4, dtype=np.float32)
+        self.collection.insert_many([
+            {'text': f"trecho {i}", 'file_name': f"membro_{i}.txt", 'chunk_index': 0, 'embedding': vector.tolist()}
+            for i, vector in enumerate(self.vectors)
+        ])
+        self.addCleanup(self.forget)
+
+    def forget(self):
+        name = self.collection.full_name
+        vector_index.forget_vector_index(name)
+        for state in (vector_index._retrieval_modes, vector_index._requested_modes, vector_index._server_unsupported_at):
+            state.pop(name, None)
+
+    def test_falls_back_when_server_pipeline_is_not_implemented(self):
+        vector_index.set_retrieval_mode(self.collection, 'server')
+        results = vector_index.search_similar_documents(self.collection, self.vectors[2], k=1)
+        self.assertEqual([doc['text'] for doc in results], ["trecho 2"])
+        self.assertIn(self.collection.full_name, vector_index._server_unsupported_at)
+
+    def test_falls_back_when_server_returns_nothing(self):
+        vector_index.set_retrieval_mode(self.collection, 'server')
+        with mock.patch('vector_index.server_side_search', return_value=[]) as server_search:
+            results = vector_index.search_similar_documents(self.collection, self.vectors[1], k=1)
+            # Marcada como sem suporte, a coleção não volta ao servidor antes do intervalo
+            vector_index.search_similar_documents(self.collection, self.vectors[1], k=1)
+        self.assertEqual(server_search.call_count, 1)
+        self.assertEqual([doc['text'] for doc in results], ["trecho 1"])
+
+    def test_keeps_client_mode_for_float16_storage(self):
+        self.collection.update_many({}, {'$set': {'embedding': encode_embedding(self.vectors[0], 'float16')}})
+        vector_index.set_retrieval_mode(self.collection, 'server')
+        self.assertEqual(vector_index._retrieval_modes[self.collection.full_name], 'client')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,330 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+from ann_backends import RESCORE_FACTOR, backend_params_from_env, create_backend
+from chunking import PASSAGE_FIELDS
+from embedding_storage import decode_embedding, stored_format
+
+logger = logging.getLogger(__name__)
+
+# Intervalo mínimo (em segundos) entre duas verificações de mudança na coleção
+REFRESH_INTERVAL = 30.0
+
+# 'client': pontua no processo do app; 'server': pontua no MongoDB e traz só os k textos
+RETRIEVAL_MODES = ('client', 'server')
+
+# Tempo (em segundos) até tentar de novo a busca no servidor depois de uma falha
+SERVER_RETRY_INTERVAL = 600.0
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Normaliza cada linha para norma 1, de modo que o produto interno seja o cosseno."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def to_passage(doc: dict, similarity: float) -> dict:
+    """Resultado de busca: o trecho recuperado, sua origem e a similaridade."""
+    return {'_id': doc['_id'], **{field: doc.get(field) for field in PASSAGE_FIELDS}, 'similarity': similarity}
+
+
+def normalize_vector(vector) -> np.ndarray:
+    """Converte a embedding da pergunta para float32 com norma 1."""
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class VectorIndex:
+    """Índice residente com as embeddings da coleção, normalizadas em float32.
+
+    A estrutura de busca é um backend plugável (exato, IVF, int8 ou HNSW). Ela é construída
+    na ingestão e persistida em disco, e os processos do app apenas a carregam. Se o
+    arquivo estiver ausente ou desatualizado, o índice é reconstruído em memória a
+    partir da coleção.
+    """
+
+    def __init__(self, collection, backend: str = None, backend_params: dict = None,
+                 index_dir: str = None, refresh_interval: float = REFRESH_INTERVAL):
+        self.collection = collection
+        # Backend de busca ('exact', 'ivf', 'int8' ou 'hnsw') e diretório onde o índice é persistido
+        self.backend_name = backend or os.getenv('VECTOR_INDEX_BACKEND', 'exact')
+        self.backend_params = backend_params_from_env(self.backend_name) if backend_params is None else backend_params
+        self.index_dir = index_dir or os.getenv('VECTOR_INDEX_DIR', './data/index')
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        # (backend, ids) trocados juntos para que buscas concorrentes vejam um estado consistente
+        self._state = (None, [])
+        self._dim = 0
+        self._fingerprint = None
+        self._checked_at = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.index_dir, f'{self.collection.full_name}.{self.backend_name}')
+
+    def _collection_fingerprint(self):
+        """Assinatura barata da coleção: quantidade de documentos e maior _id."""
+        count = self.collection.count_documents({})
+        last = self.collection.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+        return [count, str(last['_id']) if last else None]
+
+    def build(self, fingerprint=None):
+        """Lê todas as embeddings da coleção e constrói o backend de busca."""
+        fingerprint = fingerprint or self._collection_fingerprint()
+        ids, vectors = [], []
+        for doc in self.collection.find({}, {'_id': 1, 'embedding': 1}):
+            if doc.get('embedding'):
+                ids.append(doc['_id'])
+                vectors.append(decode_embedding(doc['embedding']))
+
+        backend = create_backend(self.backend_name, **self.backend_params)
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if vectors:
+            backend.build(np.ascontiguousarray(normalize_rows(matrix)))
+
+        self._state = (backend, ids)
+        self._dim = int(matrix.shape[1]) if vectors else 0
+        self._fingerprint = fingerprint
+        self._checked_at = time.monotonic()
+
+    def save(self):
+        """Persiste o índice em disco, trocando o diretório anterior de uma vez."""
+        backend, ids = self._state
+        tmp_path = f'{self.path}.tmp-{os.getpid()}'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        backend.save(tmp_path)
+        meta = {
+            'backend': self.backend_name,
+            'params': backend.params(),
+            'fingerprint': self._fingerprint,
+            'ids': [str(_id) for _id in ids],
+            'count': len(ids),
+            'dim': self._dim,
+        }
+        with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+        old_path = f'{self.path}.old-{os.getpid()}'
+        if os.path.exists(self.path):
+            os.rename(self.path, old_path)
+        os.rename(tmp_path, self.path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def load_from_disk(self, fingerprint) -> bool:
+        """Carrega o índice persistido se ele corresponder ao estado atual da coleção."""
+        try:
+            with open(os.path.join(self.path, 'meta.json'), encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta['fingerprint'] != fingerprint:
+                return False
+            # Parâmetros de consulta vindos do ambiente (ex.: n_probe, ef_search) têm prioridade
+            backend = create_backend(meta['backend'], **{**meta['params'], **self.backend_params})
+            backend.load(self.path, meta)
+        except (OSError, ValueError, KeyError):
+            return False
+
+        self._state = (backend, [ObjectId(_id) for _id in meta['ids']])
+        self._dim = meta['dim']
+        self._fingerprint = fingerprint
+        self._checked_at = time.monotonic()
+        return True
+
+    def load(self):
+        fingerprint = self._collection_fingerprint()
+        if not self.load_from_disk(fingerprint):
+            self.build(fingerprint)
+
+    def _is_fresh(self) -> bool:
+        # Nunca verificado ainda: carrega já, mesmo com o relógio monotônico perto de zero
+        return self._checked_at is not None and time.monotonic() - self._checked_at < self.refresh_interval
+
+    def refresh(self, force: bool = False):
+        """Recarrega o índice se a coleção mudou desde a última verificação."""
+        if not force and self._is_fresh():
+            return
+        with self._lock:
+            if not force and self._is_fresh():
+                return
+            if force or self._fingerprint is None or self._collection_fingerprint() != self._fingerprint:
+                self.load()
+            else:
+                self._checked_at = time.monotonic()
+
+    def search(self, query_embedding, k: int = 5) -> list[dict]:
+        """Retorna os k documentos mais similares à embedding da pergunta."""
+        self.refresh()
+        backend, ids = self._state
+        if not ids:
+            return []
+
+        query = normalize_vector(query_embedding)
+        n_candidates = k if backend.exact else k * RESCORE_FACTOR
+        rows, scores = backend.search(query, n_candidates)
+        hits = [(ids[row], float(score)) for row, score in zip(rows, scores)]
+
+        # Só os textos dos candidatos trafegam pela rede; sem scores exatos, as embeddings também
+        projection = PASSAGE_FIELDS if backend.exact else {**PASSAGE_FIELDS, 'embedding': 1}
+        docs = {
+            doc['_id']: doc
+            for doc in self.collection.find({'_id': {'$in': [_id for _id, _ in hits]}}, projection)
+        }
+
+        if not backend.exact:
+            # Reranqueia a primeira passada aproximada com os vetores em precisão total
+            hits = [
+                (_id, float(normalize_vector(decode_embedding(docs[_id]['embedding'])) @ query))
+                for _id, _ in hits
+                if docs.get(_id, {}).get('embedding') is not None
+            ]
+            hits = sorted(hits, key=lambda hit: hit[1], reverse=True)[:k]
+
+        return [
+            to_passage(docs[_id], similarity)
+            for _id, similarity in hits
+            if _id in docs and 'text' in docs[_id]
+        ]
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_vector_index(collection) -> VectorIndex:
+    """Retorna o índice compartilhado pelo processo para a coleção informada."""
+    with _indexes_lock:
+        index = _indexes.get(collection.full_name)
+        if index is None:
+            index = _indexes[collection.full_name] = VectorIndex(collection)
+        return index
+
+
+def forget_vector_index(full_name: str):
+    """Libera o índice de uma coleção que deixou de ser usada (ex.: geração substituída)."""
+    with _indexes_lock:
+        _indexes.pop(full_name, None)
+
+
+_retrieval_modes = {}
+_requested_modes = {}
+_server_unsupported_at = {}
+
+
+def server_supports(storage: str) -> bool:
+    """Se o servidor consegue pontuar embeddings gravadas no formato `storage`.
+
+    O `$vectorSearch` do Atlas lê arrays e vetores BSON float32; sem ele, o pipeline
+    com `$reduce` só funciona sobre arrays. O float16 compacto só é lido no cliente.
+    """
+    if os.getenv('ATLAS_VECTOR_INDEX'):
+        return storage in ('array', 'float32')
+    return storage == 'array'
+
+
+def set_retrieval_mode(collection, mode: str):
+    """Define como a coleção é consultada ('client' ou 'server').
+
+    O modo 'server' é conferido contra o formato em que as embeddings da coleção
+    estão de fato gravadas; se o servidor não conseguir pontuá-las, fica 'client'.
+    """
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Modo de busca desconhecido: {mode!r}. Opções: {', '.join(RETRIEVAL_MODES)}")
+    name = collection.full_name
+    # Chamado a cada execução dos apps: só confere o formato quando o modo pedido muda
+    if _requested_modes.get(name) == mode:
+        return
+    _requested_modes[name] = mode
+    if mode == 'server':
+        sample = collection.find_one({'embedding': {'$exists': True}}, {'embedding': 1})
+        storage = stored_format(sample['embedding']) if sample else None
+        if storage is not None and not server_supports(storage):
+            logger.warning("Busca no servidor não suporta embeddings '%s' em %s; usando a busca no cliente", storage, name)
+            mode = 'client'
+    _retrieval_modes[name] = mode
+
+
+def server_search_pipeline(query: list, k: int) -> list[dict]:
+    """Pipeline de agregação que calcula o top-k dentro do MongoDB.
+
+    Com ATLAS_VECTOR_INDEX definido usa o `$vectorSearch` do Atlas (índice com
+    similaridade 'cosine'). Sem ele, calcula o cosseno com `$reduce`/`$zip`, o que
+    funciona em qualquer mongod com embeddings armazenadas como arrays.
+    """
+    index_name = os.getenv('ATLAS_VECTOR_INDEX')
+    if index_name:
+        return [
+            {'$vectorSearch': {
+                'index': index_name,
+                'path': 'embedding',
+                'queryVector': query,
+                'numCandidates': max(k * 20, 100),
+                'limit': k,
+            }},
+            # O Atlas devolve (1 + cosseno) / 2; convertemos de volta para o cosseno
+            {'$project': {'_id': 1, **PASSAGE_FIELDS, 'similarity': {
+                '$subtract': [{'$multiply': [2, {'$meta': 'vectorSearchScore'}]}, 1],
+            }}},
+        ]
+
+    dot = {'$reduce': {
+        'input': {'$zip': {'inputs': ['$embedding', query]}},
+        'initialValue': 0,
+        'in': {'$add': ['$$value', {'$multiply': [{'$arrayElemAt': ['$$this', 0]}, {'$arrayElemAt': ['$$this', 1]}]}]},
+    }}
+    norm = {'$sqrt': {'$reduce': {
+        'input': '$embedding',
+        'initialValue': 0,
+        'in': {'$add': ['$$value', {'$multiply': ['$$this', '$$this']}]},
+    }}}
+    return [
+        {'$match': {'embedding.0': {'$exists': True}, 'text': {'$exists': True}}},
+        {'$project': {'_id': 1, **PASSAGE_FIELDS, 'similarity': {'$let': {
+            'vars': {'dot': dot, 'norm': norm},
+            'in': {'$cond': [{'$gt': ['$$norm', 0]}, {'$divide': ['$$dot', '$$norm']}, 0]},
+        }}}},
+        {'$sort': {'similarity': -1}},
+        {'$limit': k},
+    ]
+
+
+def server_side_search(collection, query_embedding, k: int = 5) -> list[dict]:
+    """Executa a busca vetorial no servidor; levanta erro se ele não suportar o pipeline."""
+    query = normalize_vector(query_embedding).tolist()
+    return [
+        to_passage(doc, float(doc['similarity']))
+        for doc in collection.aggregate(server_search_pipeline(query, k))
+    ]
+
+
+def search_similar_documents(collection, query_embedding, k: int = 5) -> list[dict]:
+    """Busca os k documentos mais similares no modo configurado para a coleção.
+
+    No modo 'server', se o servidor não suportar o pipeline (mongod antigo, mongomock
+    nos testes) ou não devolver nada para uma coleção com documentos (embeddings num
+    formato que o pipeline não lê), cai automaticamente para a pontuação no cliente.
+    """
+    name = collection.full_name
+    if _retrieval_modes.get(name, 'client') == 'server':
+        failed_at = _server_unsupported_at.get(name)
+        if failed_at is None or time.monotonic() - failed_at > SERVER_RETRY_INTERVAL:
+            try:
+                results = server_side_search(collection, query_embedding, k)
+                if results or k <= 0 or collection.estimated_document_count() == 0:
+                    return results
+                logger.warning("Busca no servidor sem resultados em %s; usando a busca no cliente", name)
+            except (OperationFailure, NotImplementedError):
+                # NotImplementedError: o mongomock não implementa os estágios do pipeline
+                pass
+            _server_unsupported_at[name] = time.monotonic()
+
+    return get_vector_index(collection).search(query_embedding, k)